@@ -0,0 +1,307 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import statistics
+from Bib import Bib, analyse_short_code, import_pymupdf
+
+AUTHORS = ["Smith", "M\\\"uller", "Zhang", "O'Brien", "Garcia", "Akbarzadeh", "Wei", "Block", "Ochsendorf", "Tachi"]
+TOPICS = ["Graphic-Statics", "Origami", "Topology", "4D-Printing", "Shells", "Form-Finding", "Tensegrity", "Robotics"]
+WORDS = ["structural", "design", "of", "discrete", "shells", "with", "folding", "and", "printing", "a", "method",
+         "for", "computational", "form", "finding", "graph", "analysis", "robotic", "assembly", "material"]
+
+
+def generate_library(root_folder_path, categories, entries, files, seed=0):
+    # A fake root with `categories` categories of `entries` BibTeX entries each. Each entry has `files` files, a PDF
+    # and screenshots, named "Author-Year-Theme Title.ext". About one entry in ten has incomplete BibTeX, and the
+    # Typst file in io cites one entry in ten
+    random.seed(seed)
+    pymupdf = import_pymupdf()
+    if os.path.exists(root_folder_path): shutil.rmtree(root_folder_path)
+    for folder in ["bib", "PDF", "io"]:
+        os.makedirs(os.path.join(root_folder_path, folder))
+    document = pymupdf.open()
+    document.new_page(width=200, height=280).insert_text((20, 40), " ".join(WORDS))
+    pdf_data = document.tobytes()
+    pixmap = pymupdf.Pixmap(pymupdf.csRGB, pymupdf.IRect(0, 0, 160, 120), 0)
+    pixmap.clear_with(200)
+    png_data = pixmap.tobytes("png")
+
+    short_codes = set()
+    cited = []
+    category_names = ["Category-" + chr(ord("A") + i % 26) * (1 + i // 26) for i in range(categories)]
+    for category_i, category_name in enumerate(category_names):
+        os.makedirs(os.path.join(root_folder_path, "PDF", category_name))
+        bibtex_entries = []
+        for entry_i in range(entries):
+            author = random.choice(AUTHORS)
+            year = random.randint(1950, 2024)
+            theme = "{}-{}{}".format(random.choice(TOPICS), chr(ord("A") + category_i % 26), entry_i // 5)
+            short_code = "{}-{}-{}".format(author.replace('\\"', '').replace("'", ""), year, theme)
+            suffix = 2
+            while short_code in short_codes:
+                short_code = "{}-{}-{}-{}".format(author.replace('\\"', '').replace("'", ""), year, theme, suffix)
+                suffix += 1
+            assert analyse_short_code(short_code)[2] == theme
+            short_codes.add(short_code)
+            title = " ".join(random.choice(WORDS) for _ in range(6)).capitalize()
+            fields = ["title = {{{}}}".format(title), "author = {{{}, John and Doe, Jane}}".format(author),
+                      "year = {{{}}}".format(year)]
+            if entry_i % 10 != 9:
+                fields += ["journal = {Journal of Synthetic Libraries}", "volume = {{{}}}".format(entry_i % 40 + 1),
+                           "pages = {{{}--{}}}".format(entry_i, entry_i + 10),
+                           "doi = {{https://doi.org/10.1/{}.{}}}".format(category_i, entry_i)]
+            bibtex_entries.append("@article{" + short_code + ",\n  " + ",\n  ".join(fields) + "\n}\n")
+            for file_i in range(files):
+                if file_i == 0:
+                    file_name, data = "{} {}.pdf".format(short_code, title), pdf_data
+                else:
+                    file_name, data = "{} Screenshot {}.png".format(short_code, file_i), png_data
+                with open(os.path.join(root_folder_path, "PDF", category_name, file_name), "wb") as file:
+                    file.write(data)
+            if entry_i % 10 == 0:
+                cited.append(short_code)
+        random.shuffle(bibtex_entries)
+        with open(os.path.join(root_folder_path, "bib", category_name + ".bib"), "w", encoding="utf-8") as file:
+            file.write("\n".join(bibtex_entries))
+    with open(os.path.join(root_folder_path, "io", "input.typ"), "w", encoding="utf-8") as file:
+        file.write("= Synthetic document\n\n" + "\n".join("See @{}.".format(short_code) for short_code in cited) + "\n")
+    return category_names
+
+
+def first_theme(root_folder_path, category_name):
+    file_name = sorted(os.listdir(os.path.join(root_folder_path, "PDF", category_name)))[0]
+    return analyse_short_code(file_name.split(" ", 1)[0])[2]
+
+
+def first_short_code(root_folder_path, category_name):
+    return sorted(os.listdir(os.path.join(root_folder_path, "PDF", category_name)))[0].split(" ", 1)[0]
+
+
+class DelayedDirEntry():
+    # A DirEntry of a share: its type comes with the listing, its stat is a round trip
+    def __init__(self, entry, latency):
+        self.entry, self.latency = entry, latency
+        self.name, self.path = entry.name, entry.path
+        self.stat_result = None
+
+    def is_file(self, follow_symlinks=True):
+        return self.entry.is_file(follow_symlinks=follow_symlinks)
+
+    def is_dir(self, follow_symlinks=True):
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def stat(self, follow_symlinks=True):
+        if self.stat_result is None:
+            time.sleep(self.latency)
+            self.stat_result = self.entry.stat(follow_symlinks=follow_symlinks)
+        return self.stat_result
+
+
+class DelayedScandir():
+    def __init__(self, entries, latency):
+        self.entries, self.latency = entries, latency
+
+    def __iter__(self):
+        return (DelayedDirEntry(entry, self.latency) for entry in self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.entries.close()
+
+
+@contextlib.contextmanager
+def delayed_filesystem(latency):
+    # Make each listing and stat of the local filesystem wait `latency` seconds, like a round trip to an SMB or NFS
+    # share. os.path.isfile, isdir and exists stat through os.stat, so they wait too. Reading and writing files do not
+    if not latency:
+        yield
+        return
+    listdir, scandir, stat = os.listdir, os.scandir, os.stat
+
+    def delayed_listdir(*args, **kwargs):
+        time.sleep(latency)
+        return listdir(*args, **kwargs)
+
+    def delayed_scandir(*args, **kwargs):
+        time.sleep(latency)
+        return DelayedScandir(scandir(*args, **kwargs), latency)
+
+    def delayed_stat(*args, **kwargs):
+        time.sleep(latency)
+        return stat(*args, **kwargs)
+
+    os.listdir, os.scandir, os.stat = delayed_listdir, delayed_scandir, delayed_stat
+    try:
+        yield
+    finally:
+        os.listdir, os.scandir, os.stat = listdir, scandir, stat
+
+
+# operation: (setup run before timing, timed run). The timed runs of the rename methods rename back and forth, so the
+# warm runs do the same work as the cold one
+OPERATIONS = {
+    "check": (None, lambda bib, state: bib.check(show_incomplete=False)),
+    "update_latex": (None, lambda bib, state: bib.update_latex()),
+    "generate_html_files": (lambda bib, state: bib.check(show_incomplete=False),
+                            lambda bib, state: bib.generate_html_files()),
+    "select_from_typst": (None, lambda bib, state: bib.select_from_typst()),
+    "theme_replace": (lambda bib, state: state.update(old=first_theme(bib.root_folder_path, bib.inspect_categories[0]),
+                                                      new="Renamed-Theme"),
+                      lambda bib, state: (bib.theme_replace(state["old"], state["new"]),
+                                          state.update(old=state["new"], new=state["old"]))),
+    "short_code_replace": (lambda bib, state: state.update(
+        old=first_short_code(bib.root_folder_path, bib.inspect_categories[0]), new="Renamed-2000-Short-Code"),
+                           lambda bib, state: (bib.short_code_replace(state["old"], state["new"]),
+                                               state.update(old=state["new"], new=state["old"]))),
+    "update_text_index": (lambda bib, state: bib.check(show_incomplete=False),
+                          lambda bib, state: bib.update_text_index()),
+}
+
+
+def benchmark(library_path, work_path, category_names, operation, repeat, bib_arguments, latency=0):
+    # Seconds of a cold run, on a fresh copy of the library without caches, and of `repeat` warm runs, each with a
+    # new Bib on the caches left by the previous run. With a latency, the timed runs see a delayed filesystem
+    setup, run = OPERATIONS[operation]
+    if os.path.exists(work_path): shutil.rmtree(work_path)
+    shutil.copytree(library_path, work_path)
+    state = {}
+    seconds = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for run_i in range(1 + repeat):
+            bib = Bib(category_names, root_folder_path=work_path, io_folder="io", **bib_arguments)
+            if setup and run_i == 0:
+                setup(bib, state)
+            with delayed_filesystem(latency):
+                start = time.perf_counter()
+                run(bib, state)
+                seconds.append(time.perf_counter() - start)
+    shutil.rmtree(work_path)
+    return seconds[0], seconds[1:]
+
+
+# sizes of the scaling check: 12,500 and 50,000 entries in 10 categories, one PDF each. The cold check should take
+# about the same time per entry at both sizes
+SCALING_SIZES = [(10, 1250, 1), (10, 5000, 1)]
+SCALING_TOLERANCE = 1.5  # largest ratio of the seconds per entry of the largest size to those of the smallest
+
+
+def seconds_per_entry(operation, sizes, temporary_path, bib_arguments, latency=0):
+    # Seconds per entry of the cold runs of an operation on libraries of the given sizes
+    per_entry = []
+    for categories, entries, files in sizes:
+        library_path = os.path.join(temporary_path, "library")
+        category_names = generate_library(library_path, categories, entries, files)
+        cold, _ = benchmark(library_path, os.path.join(temporary_path, "work"), category_names, operation, 0,
+                            bib_arguments, latency)
+        per_entry.append(cold / (categories * entries))
+        shutil.rmtree(library_path)
+    return per_entry
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, previous_results):
+    previous = {(r["operation"], r["size"], r["run"]): r["seconds"] for r in previous_results["results"]}
+    print("Compared with", previous_results.get("commit"))
+    for r in results["results"]:
+        before = previous.get((r["operation"], r["size"], r["run"]))
+        if before:
+            print("  {:<22} {:<12} {:<5} {:>9.3f}s -> {:>9.3f}s  x{:.2f}".format(
+                r["operation"], r["size"], r["run"], before, r["seconds"], r["seconds"] / before))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the Bib methods on synthetic libraries")
+    parser.add_argument("--sizes", default="2x50x2,4x250x2",
+                        help="comma separated sizes as CATEGORIESxENTRIESxFILES, default: 2x50x2,4x250x2")
+    parser.add_argument("--operations", default=",".join(OPERATIONS),
+                        help="comma separated operations, default: " + ",".join(OPERATIONS))
+    parser.add_argument("--repeat", type=int, default=3, help="number of warm runs, default: 3")
+    parser.add_argument("--workers", type=int, default=1, help="workers of Bib, default: 1")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="milliseconds added to each listing and stat in the timed runs, like a network share")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file of the results")
+    parser.add_argument("--compare", default=None, help="JSON file of earlier results to compare with")
+    parser.add_argument("--scaling", action="store_true",
+                        help="only time the cold runs of the operations per entry at 12,500 and 50,000 entries, and "
+                             "fail if the time per entry grows more than x{}".format(SCALING_TOLERANCE))
+    parser.add_argument("--generate", default=None, metavar="ROOT",
+                        help="only generate the library of the first size in ROOT")
+    arguments = parser.parse_args()
+
+    sizes = [tuple(int(n) for n in size.split("x")) for size in arguments.sizes.split(",")]
+    if arguments.generate:
+        generate_library(arguments.generate, *sizes[0])
+        sys.exit()
+    operations = arguments.operations.split(",")
+    for operation in operations:
+        if operation not in OPERATIONS:
+            raise NameError("Unknown operation " + operation + ", use one of " + ", ".join(OPERATIONS))
+
+    if arguments.scaling:
+        scaling = {"commit": git_commit(), "sizes": ["{}x{}x{}".format(*size) for size in SCALING_SIZES], "results": {}}
+        temporary_path = tempfile.mkdtemp(prefix="bibgallery-benchmark-")
+        try:
+            for operation in operations:
+                per_entry = seconds_per_entry(operation, SCALING_SIZES, temporary_path, {"workers": arguments.workers},
+                                              arguments.latency / 1000)
+                scaling["results"][operation] = per_entry
+                print("{:<22} {}  x{:.2f}".format(operation, "  ".join(
+                    "{} entries {:.3f}ms/entry".format(categories * entries, seconds * 1000)
+                    for (categories, entries, _), seconds in zip(SCALING_SIZES, per_entry)),
+                    per_entry[-1] / per_entry[0]))
+        finally:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+        with open(arguments.output, "w", encoding="utf-8") as file:
+            json.dump(scaling, file, indent=1)
+        print("Results saved in", arguments.output)
+        failed = [operation for operation, per_entry in scaling["results"].items()
+                  if per_entry[-1] / per_entry[0] > SCALING_TOLERANCE]
+        if failed:
+            sys.exit("Time per entry grew more than x{} for {}".format(SCALING_TOLERANCE, ", ".join(failed)))
+        sys.exit()
+
+    results = {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+               "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "workers": arguments.workers,
+               "latency": arguments.latency, "results": []}
+    temporary_path = tempfile.mkdtemp(prefix="bibgallery-benchmark-")
+    try:
+        for categories, entries, files in sizes:
+            size = "{}x{}x{}".format(categories, entries, files)
+            library_path = os.path.join(temporary_path, "library")
+            category_names = generate_library(library_path, categories, entries, files)
+            for operation in operations:
+                cold, warm = benchmark(library_path, os.path.join(temporary_path, "work"), category_names, operation,
+                                       arguments.repeat, {"workers": arguments.workers}, arguments.latency / 1000)
+                runs = [("cold", cold)] + ([("warm", statistics.median(warm))] if warm else [])
+                for run, seconds in runs:
+                    results["results"].append({"operation": operation, "size": size, "categories": categories,
+                                               "entries": entries, "files": files, "run": run, "seconds": seconds})
+                print("{:<22} {:<12} cold {:>9.3f}s".format(operation, size, cold) +
+                      ("  warm {:>9.3f}s (median of {})".format(statistics.median(warm), len(warm)) if warm else ""))
+    finally:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+
+    with open(arguments.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=1)
+    print("Results saved in", arguments.output)
+    if arguments.compare:
+        with open(arguments.compare, encoding="utf-8") as file:
+            compare(results, json.load(file))
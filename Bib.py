@@ -1,17 +1,58 @@
 __author__ = "Yefan Zhi"
 
 import os
-import pandas as pd
-import pdf2bib
 import shutil
 import re
 import codecs
 import bibtexparser
 import bibtexparser.middlewares as bm
 import pathlib
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+import hashlib
+import json
+import csv
+import pickle
+import mmap
+import sqlite3
+import urllib.parse
+import asyncio
+import mimetypes
 import time
+import threading
+import contextlib
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter, deque
+import math
+import unicodedata
+import zlib
+
+# pandas, numpy, pdf2bib, PyMuPDF and watchdog take most of the import time, so they are imported by the functions that
+# use them, and commands such as select_from_typst do not pay for them
+
+CATALOG_SCHEMA_VERSION = 1
+PARALLEL_CHUNK_ENTRIES = 500  # entries per process pool task when a category file is split
+TYPST_REFERENCE_PATTERN = re.compile(r'@([A-Za-z0-9\-]*)')
+TYPST_LABEL_PATTERN = re.compile(r'<([A-Za-z0-9\-]+-\d{4}-[A-Za-z0-9\-]+)>')
+TYPST_YEAR_PATTERN = re.compile(r'\b[a-zA-Z-]*\d{4}[a-zA-Z-]*\b')
+TYPST_INCLUDE_PATTERN = re.compile(r'\binclude\s*\(?\s*"([^"]+)"')
+TEXT_TOKEN_PATTERN = re.compile(r"\b[^\W_]{2,30}\b")
+BIBTEX_ENTRY_HEAD_PATTERN = re.compile(rb"\s*@\s*(\w+)\s*[{(](?:\s*([^,\s]+)\s*,)?")
+# a line starting a block, an entry or an @comment, @string or @preamble, and the braces that close it
+BIBTEX_ENTRY_START_PATTERN = re.compile(rb"^[ \t]*@[ \t]*\w+[ \t]*(?:(\{)|\()", re.M)
+BIBTEX_BRACE_PATTERN = re.compile(rb"(\{)|\}")
+BIBTEX_STRING_ENTRY_START_PATTERN = re.compile(BIBTEX_ENTRY_START_PATTERN.pattern.decode(), re.M)
+BIBTEX_STRING_BRACE_PATTERN = re.compile(BIBTEX_BRACE_PATTERN.pattern.decode())
+BIBTEX_FIELD_PATTERN = re.compile(r'^\s*(\w+)\s*=\s*[{"](.*?)[}"]\s*,?\s*$', re.M)
+LATEX_COMMAND_PATTERN = re.compile(r"\\[a-zA-Z]+|\\.")
+MINHASH_PRIME = 4294967311  # a prime above 2^32, the range of the shingle hashes
+SERVE_CHUNK_SIZE = 1 << 20  # bytes per write when Bib.serve sends a file
+SERVE_KEEP_ALIVE = 15  # seconds between comments on idle event streams
+REPORT_CHUNK_ROWS = 1000  # rows per write of the check reports
+TRACE_MAX_SPANS = 100  # outermost spans kept in trace.json, the oldest are dropped first
+# reports of Bib.check by name, and the columns written by default, all but the BibTeX bodies
+CHECK_REPORTS = {"all": "BibCheckResultAll.md", "non_books": "BibCheckResultNonBooks.md", "csv": "BibCheckResultAll.csv"}
+REPORT_COLUMNS = ["Category", "Theme", "Type", "t", "B", "P", "Title", "f", "Pf", "Link"]
+HTTP_REASONS = {200: "OK", 302: "Found", 304: "Not Modified", 404: "Not Found", 405: "Method Not Allowed"}
 
 
 def analyse_short_code(string):
@@ -40,9 +81,37 @@ def compress_string(string):
         return string[:40] + "..." + string[-20:]
 
 
+def title_shorter(x):
+    return x[:47] + "..." if len(x) > 50 else x
+
+
+def write_if_changed(file_path, content):
+    # Replace the file atomically, and only if its content changes, so tools watching the mtime are not triggered
+    data = content.encode("utf-8")
+    try:
+        with open(file_path, "rb") as file:
+            if file.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    save_atomically(file_path, data)
+    return True
+
+
+def contains_year(input_string):
+    return TYPST_YEAR_PATTERN.search(input_string) is not None
+
+
+def collect_short_code_from_typst(input_data):
+    # @Short-Code references and <Short-Code> labels with a year
+    return set([x for x in TYPST_REFERENCE_PATTERN.findall(input_data) if contains_year(x)] +
+               TYPST_LABEL_PATTERN.findall(input_data))
+
+
 def write_to_end_of_file(file_path, content):
     with codecs.open(file_path, 'a', "utf8") as file:
         file.write(content)
+    trace_count("bytes written", len(content.encode("utf-8")))
 
 
 def find_substring_locations_regex(A, B):
@@ -50,6 +119,94 @@ def find_substring_locations_regex(A, B):
     return [match.start() for match in pattern.finditer(A)]
 
 
+def save_atomically(file_path, data):
+    temporary_path = file_path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(data)
+    os.replace(temporary_path, file_path)
+    trace_count("bytes written", len(data))
+
+
+def load_json(file_path, default):
+    try:
+        with codecs.open(file_path, "r", "utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def save_json(file_path, data):
+    save_atomically(file_path, json.dumps(data, ensure_ascii=False, indent=1).encode("utf-8"))
+
+
+def load_pickle(file_path, default):
+    try:
+        with open(file_path, "rb") as file:
+            return pickle.load(file)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return default
+
+
+def save_pickle(file_path, data):
+    save_atomically(file_path, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def report_cell(value):
+    # a value as pandas prints it in a DataFrame of objects
+    if value is None:
+        return "None"
+    if isinstance(value, float) and math.isnan(value):
+        return "NaN"
+    if isinstance(value, list):
+        return "[" + ", ".join(report_cell(item) for item in value) + "]"
+    return str(value).replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def write_table_report(file_path, df, columns):
+    # Write the columns of a DataFrame as print shows it with unlimited display options, streaming the rows in chunks
+    # instead of building the whole table as one string
+    with open(file_path, "w", encoding="utf-8", newline="") as file:
+        if df.empty:
+            file.write("Empty DataFrame\nColumns: [" + ", ".join(columns) + "]\nIndex: []\n")
+            return
+        index = [str(label) for label in df.index]
+        index_width = max(len(label) for label in index)
+        widths = [max(len(column), max(len(report_cell(value)) for value in df[column]) + 1) for column in columns]
+        file.write(" " * index_width + " " + " ".join(column.rjust(width) for column, width in zip(columns, widths)))
+        values = [df[column].tolist() for column in columns]
+        for start in range(0, len(index), REPORT_CHUNK_ROWS):
+            lines = []
+            for i in range(start, min(start + REPORT_CHUNK_ROWS, len(index))):
+                lines.append(index[i].ljust(index_width) + " " + " ".join(
+                    (" " + report_cell(column_values[i])).rjust(width) for column_values, width in zip(values, widths)))
+            file.write("\n" + "\n".join(lines))
+        file.write("\n")
+    trace_written(file_path)
+
+
+def trusted_mtime(mtime_ns):
+    # an mtime from the last two seconds may still be shared by a later edit, so it is not trusted
+    return mtime_ns if time.time_ns() - mtime_ns > 2e9 else None
+
+
+def file_fingerprint(file_path, previous=None, stat=None):
+    # stat may come from a LibrarySnapshot, to save a round trip
+    stat = stat or os.stat(file_path)
+    if previous and previous["mtime"] == stat.st_mtime_ns and previous["size"] == stat.st_size:
+        return previous
+    with open(file_path, "rb") as file:
+        content_hash = hashlib.sha1(file.read()).hexdigest()
+    return {"mtime": trusted_mtime(stat.st_mtime_ns), "size": stat.st_size, "hash": content_hash}
+
+
+def same_fingerprint(previous, current):
+    return previous is not None and previous["hash"] == current["hash"]
+
+
+def hash_string(string):
+    return hashlib.sha1(string.encode("utf-8")).hexdigest()
+
+
 def main_parser(bibtex_string):
     # https://github.com/sciunto-org/python-bibtexparser
     # https://bibtexparser.readthedocs.io/en/main/
@@ -62,6 +219,208 @@ def main_parser(bibtex_string):
     return bibtexparser.write_string(bib_database).replace("https://doi.org/", "")
 
 
+def normalize_entries(bibtex_string, encode=False):
+    # The (key, block) pairs that main_parser (or latex_encode) writes for a string holding only entries.
+    # Returns None if there are comments, strings, preambles or failed blocks
+    if encode:
+        bib_database = bibtexparser.parse_string(bibtex_string, append_middleware=[bm.LatexEncodingMiddleware()])
+    else:
+        bibtex_string = bibtex_string.replace("\\" + "&", "&").replace("&", "\\" + "&")
+        bib_database = bibtexparser.parse_string(bibtex_string, append_middleware=[bm.LatexDecodingMiddleware()])
+    if len(bib_database.entries) != len(bib_database.blocks):
+        return None
+    normalized = []
+    for entry in bib_database.entries:
+        block = bibtexparser.write_string(bibtexparser.Library([entry]))
+        normalized.append((entry.key, block if encode else block.replace("https://doi.org/", "")))
+    return normalized
+
+
+def bibtex_block_starts(data, start_pattern=BIBTEX_ENTRY_START_PATTERN, brace_pattern=BIBTEX_BRACE_PATTERN):
+    # Offsets of the lines starting a block: an "@", a type and an opening brace, outside the braces of the previous
+    # block, so that a line of a field starting with "@" does not cut its entry. A block whose braces are not closed,
+    # or delimited by parentheses, ends at the next line that looks like the start of a block
+    starts = []
+    position = 0
+    for match in start_pattern.finditer(data):
+        if match.start() < position: continue
+        starts.append(match.start())
+        position = match.end()
+        if match.group(1) is None: continue
+        depth = 1
+        for brace in brace_pattern.finditer(data, match.end()):
+            depth += 1 if brace.group(1) is not None else -1
+            if depth == 0:
+                position = brace.end()
+                break
+    return starts
+
+
+def split_bibtex_string(bibtex_string, chunk_entries):
+    # Chunks of at most chunk_entries blocks, cut before the lines starting a block
+    starts = bibtex_block_starts(bibtex_string, BIBTEX_STRING_ENTRY_START_PATTERN, BIBTEX_STRING_BRACE_PATTERN)
+    if not starts or (starts[0] != 0 and bibtex_string[:starts[0]].strip()):
+        starts.insert(0, 0)
+    starts[0] = 0
+    return [bibtex_string[starts[i]:starts[i + chunk_entries] if i + chunk_entries < len(starts) else None]
+            for i in range(0, len(starts), chunk_entries)]
+
+
+def index_bibtex_file(bibtex_file_path):
+    # {short code: (byte offset, length, content hash)} of the first entry of each short code in a .bib file, and
+    # whether it has @string blocks, whose macros the entries read alone would miss
+    index, strings = {}, False
+    with BibtexEntryReader(bibtex_file_path) as reader:
+        for entry_type, short_code, start, end in reader:
+            if entry_type is not None and entry_type.lower() == "string":
+                strings = True
+            if short_code is None or entry_type.lower() in ["comment", "string", "preamble"]: continue
+            if short_code not in index:
+                index[short_code] = (start, end - start, hashlib.sha1(reader.read(start, end)).hexdigest())
+    return index, strings
+
+
+def list_folder(folder_path):
+    # the DirEntry objects of a folder, an empty list if it does not exist
+    try:
+        with os.scandir(folder_path) as entries:
+            return list(entries)
+    except FileNotFoundError:
+        return []
+
+
+class LibrarySnapshot():
+    # Listings of the .bib folder and of the category folders of the PDF folder, shared by the methods of a Bib. They
+    # are made with os.scandir, whose DirEntry objects know the type of each file without a stat, and the category
+    # folders are listed concurrently on a thread pool, so a library on a network share costs a few round trips
+    # instead of one per file. refresh lists again only the folders whose mtime changed, or was too recent to trust
+    def __init__(self, bibtex_path, pdf_path, threads=8):
+        self.bibtex_path = bibtex_path
+        self.pdf_path = pdf_path
+        self.threads = threads
+        self.bib_files = {}  # {file name: stat} of the files of the .bib folder, in listing order
+        self.folders = {}  # {category: {"mtime", "trusted", "file_names"}} of the PDF folder, in listing order
+
+    def refresh(self):
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            bib_listing = executor.submit(list_folder, self.bibtex_path)
+            pdf_listing = executor.submit(list_folder, self.pdf_path)
+            bib_entries = [entry for entry in bib_listing.result() if entry.is_file()]
+            bib_stats = executor.map(lambda entry: entry.stat(), bib_entries)
+            category_entries = [entry for entry in pdf_listing.result() if entry.is_dir()]
+            mtimes = list(executor.map(lambda entry: entry.stat().st_mtime_ns, category_entries))
+            folders = {}
+            for entry, mtime in zip(category_entries, mtimes):
+                previous = self.folders.get(entry.name)
+                if previous and previous["trusted"] and previous["mtime"] == mtime:
+                    folders[entry.name] = previous
+                else:
+                    folders[entry.name] = executor.submit(self.list_category, entry.path, mtime)
+            self.bib_files = {entry.name: stat for entry, stat in zip(bib_entries, bib_stats)}
+        count_listed = 0
+        for category_name, folder in folders.items():
+            if not isinstance(folder, dict):
+                folders[category_name] = folder.result()
+                count_listed += 1
+        self.folders = folders
+        trace_count("folders scanned", count_listed)
+        return self
+
+    def list_category(self, folder_path, mtime):
+        # mtime is taken before the listing, so a change during the listing is seen by the next refresh
+        return {"mtime": mtime, "trusted": trusted_mtime(mtime) is not None,
+                "file_names": [entry.name for entry in list_folder(folder_path) if entry.is_file()]}
+
+    def bibtex_file_fingerprint(self, category_name, previous=None):
+        file_name = category_name + ".bib"
+        return file_fingerprint(os.path.join(self.bibtex_path, file_name), previous, self.bib_files.get(file_name))
+
+    def folder_fingerprint(self, category_name, previous=None):
+        # returns the fingerprint of a category folder and its file names in listing order, or None if the folder is
+        # unchanged
+        if category_name not in self.folders:
+            raise FileNotFoundError("No folder " + os.path.join(self.pdf_path, category_name))
+        folder = self.folders[category_name]
+        if previous and previous["mtime"] == folder["mtime"]:
+            return previous, None
+        listing_hash = hashlib.sha1("\n".join(folder["file_names"]).encode("utf-8")).hexdigest()
+        return {"mtime": trusted_mtime(folder["mtime"]), "hash": listing_hash}, list(folder["file_names"])
+
+    def file_names(self, category_name):
+        # the files of a category folder, an empty list if there is no folder
+        return list(self.folders[category_name]["file_names"]) if category_name in self.folders else []
+
+
+class BibtexEntryReader():
+    # A memory-mapped .bib file, cut into blocks before the lines starting a block (see bibtex_block_starts). Iterating
+    # yields the entry type, key, start and end of each block without copying the file; the type is None for a block
+    # without a head, and the key for a block without one such as @string. Only the blocks passed to read are copied
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = None
+        self.data = None
+
+    def __enter__(self):
+        self.file = open(self.file_path, "rb")
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.data is not None:
+            self.data.close()
+        self.file.close()
+
+    def __iter__(self):
+        if self.data is None: return
+        starts = bibtex_block_starts(self.data)
+        if not starts or starts[0] != 0:
+            starts.insert(0, 0)
+        for start, end in zip(starts, starts[1:] + [len(self.data)]):
+            yield self.block(start, end)
+
+    def block(self, start, end):
+        match = BIBTEX_ENTRY_HEAD_PATTERN.match(self.data, start, end)
+        if not match:
+            return None, None, start, end
+        key = match.group(2)
+        return match.group(1).decode("utf-8"), key.decode("utf-8") if key is not None else None, start, end
+
+    def read(self, start, end):
+        return self.data[start:end]
+
+    def find(self, sub, start, end):
+        return self.data.find(sub, start, end)
+
+
+class BibtexEntryWriter():
+    # Writes a .bib file block by block into a temporary file, which replaces the file when the writer is closed
+    # without an error
+    def __init__(self, file_path, separator=""):
+        self.file_path = file_path
+        self.separator = separator.encode("utf-8")
+        self.file = None
+        self.count = 0
+
+    def __enter__(self):
+        self.file = open(self.file_path + ".tmp", "wb")
+        return self
+
+    def write(self, block):
+        if self.count and self.separator:
+            self.file.write(self.separator)
+        self.file.write(block if isinstance(block, bytes) else block.encode("utf-8"))
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.file_path + ".tmp", self.file_path)
+            trace_written(self.file_path)
+        else:
+            os.remove(self.file_path + ".tmp")
+
+
 def analyze_bibtex_single_item(bibtex_string):
     bib_database = bibtexparser.parse_string(
         bibtex_string, append_middleware=[bm.SeparateCoAuthors(),  # Co-authors should be separated as list of strings
@@ -69,12 +428,882 @@ def analyze_bibtex_single_item(bibtex_string):
     return bib_database.entries[0]
 
 
+def make_valid_filename(filename):
+    valid_filename = re.sub(r'[\\/:"*?<>|]', '', filename)
+    valid_filename = valid_filename.strip()
+    return valid_filename
+
+
+def move_file(source_path, destination_path):
+    try:
+        shutil.move(source_path, destination_path)
+    except FileNotFoundError:
+        raise NameError(f"File '{source_path}' not found.")
+    except Exception as e:
+        raise NameError(f"Error: {str(e)}")
+
+
+def bib_single_new_short_code(bib, short_code):
+    left = bib.split("{")[0]
+    right = bib.split(",", 1)[1]
+    return left + "{" + short_code + "," + right
+
+
+def import_pymupdf():
+    try:
+        import pymupdf
+    except ImportError:  # PyMuPDF < 1.24.3
+        import fitz as pymupdf
+    return pymupdf
+
+
+def resolve_with_pdf2bib(pdf_file_path):
+    # Default resolver of Bib.collect: the BibTeX string of a PDF, or None
+    import pdf2bib
+    # pdf2bib.config.set('save_identifier_metadata', False)
+    pdf2bib.config.set('verbose', False)
+    result = pdf2bib.pdf2bib(pdf_file_path)
+    return result['bibtex'] if result else None
+
+
+def propose_collect_item(bib_string, pdf_file, available=None):
+    # Short code, BibTeX string and new file name of a PDF named as its theme. available(short_code) may give another
+    # short code for one that is taken
+    theme = pdf_file[:-4].strip().replace(" ", "-")
+    bibtex_single_item = analyze_bibtex_single_item(bib_string)
+    short_code = bibtex_single_item["author"][0].last[0] + "-" + bibtex_single_item["year"] + "-" + theme
+    if available is not None:
+        short_code = available(short_code)
+    bib_string = bib_single_new_short_code(bib_string, short_code)
+    new_file_name = make_valid_filename(short_code + " " + bibtex_single_item["title"] + ".pdf")
+    return short_code, bib_string, new_file_name
+
+
 def latex_encode(bibtex_string):
     bib_database = bibtexparser.parse_string(
         bibtex_string, append_middleware=[bm.LatexEncodingMiddleware()])
     return bibtexparser.write_string(bib_database)
 
 
+def tokenize_text(text):
+    return TEXT_TOKEN_PATTERN.findall(text.lower())
+
+
+def extract_pdf_terms(pdf_file_path):
+    # Counts of the terms in the text of a PDF, or None if it cannot be read
+    pymupdf = import_pymupdf()
+    try:
+        with pymupdf.open(pdf_file_path) as document:
+            text = " ".join(page.get_text() for page in document)
+    except Exception:
+        return None
+    return dict(Counter(tokenize_text(text)))
+
+
+def bibtex_fields(bibtex_string):
+    # {field name: value} of the fields written on one line, as in the parsed BibTeX
+    return {name.lower(): value for name, value in BIBTEX_FIELD_PATTERN.findall(bibtex_string)}
+
+
+def normalize_text(text):
+    # lower case ASCII words, without LaTeX commands, accents and punctuation
+    text = unicodedata.normalize("NFKD", LATEX_COMMAND_PATTERN.sub("", text))
+    return " ".join(re.findall(r"[a-z0-9]+", text.encode("ascii", "ignore").decode("ascii").lower()))
+
+
+def minhash_signature(shingles, permutations):
+    # the minimum of each (a * x + b) mod p over the hashes x of the shingles
+    import numpy as np
+    hashes = np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in shingles], dtype=np.uint64)
+    a, b = permutations
+    return ((np.outer(a, hashes) + b[:, None]) % np.uint64(MINHASH_PRIME)).min(axis=1)
+
+
+def make_thumbnail(source_path, thumbnail_path, height):
+    # Downscaled JPEG of an image, or of the first page of a PDF. Returns the width, height and mtime of the source
+    # rendered, or None if it cannot be rendered. The thumbnail takes the mtime of its source
+    pymupdf = import_pymupdf()
+    try:
+        source_mtime = os.stat(source_path).st_mtime_ns
+        if source_path.lower().endswith(".pdf"):
+            with pymupdf.open(source_path) as document:
+                page = document[0]
+                zoom = height / page.rect.height
+                pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+        else:
+            pixmap = pymupdf.Pixmap(source_path)
+            if pixmap.alpha:
+                pixmap = pymupdf.Pixmap(pixmap, 0)
+            if pixmap.colorspace is None or pixmap.colorspace.n not in [1, 3]:
+                pixmap = pymupdf.Pixmap(pymupdf.csRGB, pixmap)
+            if pixmap.height > height:
+                pixmap = pymupdf.Pixmap(pixmap, max(1, round(pixmap.width * height / pixmap.height)), height, None)
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        pixmap.save(thumbnail_path + ".tmp.jpg", jpg_quality=85)
+        os.replace(thumbnail_path + ".tmp.jpg", thumbnail_path)
+        os.utime(thumbnail_path, ns=(source_mtime, source_mtime))
+        trace_written(thumbnail_path)
+        return pixmap.width, pixmap.height, source_mtime
+    except Exception as e:
+        print("- Thumbnail failed for", compress_string(os.path.basename(source_path)) + ":", e)
+        return None
+
+
+active_instrumentation = threading.local()
+
+
+def trace_count(name, value=1):
+    # Add to a counter of the current span of the Bib running in this thread, if its instrumentation is enabled, or to
+    # the counts collected by map_counted in a worker thread
+    instrumentation = getattr(active_instrumentation, "instrumentation", None)
+    if instrumentation is not None:
+        instrumentation.count(name, value)
+        return
+    counts = getattr(active_instrumentation, "counts", None)
+    if counts is not None:
+        counts[name] = counts.get(name, 0) + value
+
+
+def trace_written(file_path):
+    if getattr(active_instrumentation, "instrumentation", None) is not None or \
+            getattr(active_instrumentation, "counts", None) is not None:
+        trace_count("bytes written", os.path.getsize(file_path))
+
+
+def map_counted(executor, function, *iterables):
+    # executor.map over worker threads, whose counts are returned with each result and added to the current span by
+    # the caller, as the spans of the caller are not open in the workers
+    def call(*arguments):
+        active_instrumentation.counts = counts = {}
+        try:
+            return function(*arguments), counts
+        finally:
+            active_instrumentation.counts = None
+
+    results = []
+    for result, counts in executor.map(call, *iterables):
+        for name, value in counts.items():
+            trace_count(name, value)
+        results.append(result)
+    return results
+
+
+def trace_phase(name):
+    instrumentation = getattr(active_instrumentation, "instrumentation", None)
+    if instrumentation is not None:
+        instrumentation.phase(name)
+
+
+def traced(method):
+    # Run a method of Bib in a span of its instrumentation
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.instrumentation.span(method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class Instrumentation():
+    # Nested timed spans with counters. Off by default, and then a span costs a function call. When an outermost span
+    # ends, the trace of the last TRACE_MAX_SPANS outermost spans is saved as JSON and a summary of the span is printed
+    def __init__(self, enabled=False, trace_file_path=None):
+        self.enabled = enabled
+        self.trace_file_path = trace_file_path
+        self.spans = deque(maxlen=TRACE_MAX_SPANS)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def stack(self):
+        # [span, start, is phase] of the open spans of this thread
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        previous = getattr(active_instrumentation, "instrumentation", None)
+        active_instrumentation.instrumentation = self
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end()
+            active_instrumentation.instrumentation = previous
+
+    def begin(self, name, is_phase=False):
+        span = {"name": name, "start": time.time(), "seconds": None, "counters": {}, "children": []}
+        stack = self.stack()
+        if stack:
+            stack[-1][0]["children"].append(span)
+        stack.append([span, time.perf_counter(), is_phase])
+
+    def end(self):
+        # end the open span, and its open phase first
+        if self.stack()[-1][2]:
+            self.finish()
+        self.finish()
+
+    def finish(self):
+        stack = self.stack()
+        span, start, _ = stack.pop()
+        span["seconds"] = time.perf_counter() - start
+        if not stack:
+            with self.lock:
+                self.spans.append(span)
+                if self.trace_file_path:
+                    os.makedirs(os.path.dirname(self.trace_file_path), exist_ok=True)
+                    save_json(self.trace_file_path, {"spans": list(self.spans)})
+            print(self.summary(span))
+
+    def phase(self, name):
+        # Close the current phase of the open span, if any, and start the next one
+        stack = self.stack()
+        if not self.enabled or not stack: return
+        if stack[-1][2]:
+            self.finish()
+        self.begin(name, is_phase=True)
+
+    def count(self, name, value=1):
+        stack = self.stack()
+        if not self.enabled or not stack: return
+        counters = stack[-1][0]["counters"]
+        counters[name] = counters.get(name, 0) + value
+
+    def summary(self, span):
+        totals = {}
+        lines = []
+
+        def add(span, depth):
+            for name, value in span["counters"].items():
+                totals[name] = totals.get(name, 0) + value
+            lines.append("{}{} {:.3f}s{}".format("  " * depth, span["name"], span["seconds"], "".join(
+                "  {}: {}".format(name, value) for name, value in sorted(span["counters"].items()))))
+            for child in span["children"]:
+                add(child, depth + 1)
+
+        add(span, 0)
+        lines[0] = "[TRACE] " + lines[0]
+        if totals:
+            lines.append("  Total" + "".join("  {}: {}".format(name, value) for name, value in sorted(totals.items())))
+        return "\n".join(lines) + "\n"
+
+
+class DebouncedQueue():
+    # Collects items by key and hands them out together once no item arrived for quiet_period seconds,
+    # or at the latest max_delay seconds after the first item of the burst
+    def __init__(self, quiet_period, max_delay=None):
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay if max_delay is not None else 10 * quiet_period
+        self.pending = {}
+        self.first_time, self.last_time = 0, 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, key, item):
+        with self.condition:
+            if not self.pending:
+                self.first_time = time.monotonic()
+            self.pending.setdefault(key, []).append(item)
+            self.last_time = time.monotonic()
+            self.condition.notify()
+
+    def get(self):
+        # {key: [items]} of the next burst, or None once the queue is closed
+        with self.condition:
+            while not self.closed:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                now = time.monotonic()
+                remaining = min(self.last_time + self.quiet_period, self.first_time + self.max_delay) - now
+                if remaining <= 0:
+                    pending, self.pending = self.pending, {}
+                    return pending
+                self.condition.wait(remaining)
+            return None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class GalleryServer():
+    # Local HTTP server of the gallery of a Bib. Pages are rendered from the in-memory index on request and cached
+    # until their category is updated, with the hash of the page as ETag. Thumbnails and PDFs are served from their
+    # folders, and the open pages are told of updates by Server-Sent Events on /events
+    def __init__(self, bib):
+        self.bib = bib
+        self.lock = threading.Lock()  # held while the index is rendered or updated
+        self.pages = {}  # (category, theme) -> {page file name: (ETag, HTML)}
+        self.search_index = None
+        self.listeners = set()  # queues of the open event streams
+        self.loop = None
+        self.counters = {"requests": 0, "pages rendered": 0, "not modified": 0, "events sent": 0}
+
+    @staticmethod
+    def file_url(category_name, file_name):
+        return "files/{}/{}".format(urllib.parse.quote(category_name), urllib.parse.quote(file_name))
+
+    def updated(self, categories):
+        # Called by the watcher once the index was updated, None for all categories
+        with self.lock:
+            if categories is None:
+                self.pages.clear()
+            else:
+                for key in [key for key in self.pages if key[0] in categories]:
+                    del self.pages[key]
+            if self.bib.gallery_options["search"]:
+                self.bib.update_text_index(self.bib.gallery_df)
+                self.search_index = None
+        self.loop.call_soon_threadsafe(self.notify, ["*"] if categories is None else sorted(categories))
+
+    def notify(self, categories):
+        for queue in self.listeners:
+            for category_name in categories:
+                queue.put_nowait(category_name)
+
+    def page(self, page_file_name, theme):
+        # (ETag, HTML) of a page of the gallery, or None
+        match = re.fullmatch(r"(.+?)(_page\d+)?\.html", page_file_name)
+        if not match or match.group(1) not in self.bib.inspect_categories: return None
+        category_name = match.group(1)
+        with self.lock:
+            if (category_name, theme) not in self.pages:
+                pages = {}
+                for name, pieces in self.bib.render_gallery_pages(category_name, theme, self.file_url,
+                                                                  live_reload=True):
+                    # the server keeps the pages it sends in memory, as one body each
+                    body = "".join(pieces).encode("utf-8")
+                    pages[name] = ('"' + hashlib.sha1(body).hexdigest() + '"', body)
+                self.pages[(category_name, theme)] = pages
+                self.counters["pages rendered"] += len(pages)
+            pages = self.pages[(category_name, theme)]
+        if theme is not None:
+            return next(iter(pages.values()), None)
+        return pages.get(page_file_name)
+
+    async def handle(self, reader, writer):
+        # Requests of a connection, kept alive as long as the client asks for it
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip(): break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip(): break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                method, target, version = request_line.decode("latin-1").split()
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                if not await self.respond(writer, method, target, headers, keep_alive): break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def write_head(self, writer, status, headers, keep_alive):
+        lines = ["HTTP/1.1 {} {}".format(status, HTTP_REASONS[status])]
+        lines += ["{}: {}".format(name, value) for name, value in headers.items()]
+        lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def respond(self, writer, method, target, headers, keep_alive):
+        # Writes the response to a request. Returns whether the connection stays open
+        self.counters["requests"] += 1
+        url = urllib.parse.urlsplit(target)
+        path = urllib.parse.unquote(url.path).lstrip("/")
+        parts = path.split("/")
+
+        async def send(status, body=b"", content_type="text/plain; charset=utf-8", etag=None, extra_headers=None):
+            response_headers = {"Content-Type": content_type, "Cache-Control": "no-cache"}
+            if etag is not None:
+                response_headers["ETag"] = etag
+                if headers.get("if-none-match") == etag:
+                    self.counters["not modified"] += 1
+                    status, body = 304, b""
+            response_headers.update(extra_headers or {})
+            response_headers["Content-Length"] = len(body)
+            self.write_head(writer, status, response_headers, keep_alive)
+            if method != "HEAD": writer.write(body)
+            await writer.drain()
+            return keep_alive
+
+        if method not in ["GET", "HEAD"]:
+            return await send(405, b"Method not allowed")
+        if path == "events":
+            await self.stream_events(writer)
+            return False
+        if path == "":
+            return await send(302, extra_headers={"Location": "/" + urllib.parse.quote(
+                self.bib.html_file_path_dict[self.bib.inspect_categories[0]])})
+        if path == "search_index.js" and self.bib.gallery_options["search"]:
+            with self.lock:
+                if self.search_index is None:
+                    script = self.bib.search_index_script(file_url=self.file_url).encode("utf-8")
+                    self.search_index = ('"' + hashlib.sha1(script).hexdigest() + '"', script)
+                etag, body = self.search_index
+            return await send(200, body, "text/javascript; charset=utf-8", etag)
+        if len(parts) == 1 and path.endswith(".html"):
+            theme = urllib.parse.parse_qs(url.query).get("theme", [None])[0]
+            page = await asyncio.to_thread(self.page, path, theme)
+            if page is None:
+                return await send(404, b"Not found")
+            return await send(200, page[1], "text/html; charset=utf-8", page[0])
+        if len(parts) == 3 and parts[0] in ["thumbnails", "files"] and parts[1] in self.bib.inspect_categories and \
+                parts[2] == os.path.basename(parts[2]) and parts[2] not in ["", ".", ".."]:
+            folder_path = os.path.join(self.bib.html_path, "thumbnails") if parts[0] == "thumbnails" else \
+                self.bib.pdf_path
+            return await self.send_file(writer, os.path.join(folder_path, parts[1], parts[2]), method, headers,
+                                        keep_alive)
+        return await send(404, b"Not found")
+
+    async def send_file(self, writer, file_path, method, headers, keep_alive):
+        # The file in chunks, with its mtime and size as ETag
+        try:
+            file = open(file_path, "rb")
+        except OSError:
+            body = b"Not found"
+            self.write_head(writer, 404, {"Content-Type": "text/plain; charset=utf-8", "Content-Length": len(body)},
+                            keep_alive)
+            writer.write(body)
+            await writer.drain()
+            return keep_alive
+        with file:
+            stat = os.fstat(file.fileno())
+            etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+            response_headers = {"Content-Type": mimetypes.guess_type(file_path)[0] or "application/octet-stream",
+                                "Cache-Control": "no-cache", "ETag": etag}
+            if headers.get("if-none-match") == etag:
+                self.counters["not modified"] += 1
+                response_headers["Content-Length"] = 0
+                self.write_head(writer, 304, response_headers, keep_alive)
+                await writer.drain()
+                return keep_alive
+            response_headers["Content-Length"] = stat.st_size
+            self.write_head(writer, 200, response_headers, keep_alive)
+            await writer.drain()
+            while method != "HEAD":
+                chunk = file.read(SERVE_CHUNK_SIZE)
+                if not chunk: break
+                writer.write(chunk)
+                await writer.drain()
+        return keep_alive
+
+    async def stream_events(self, writer):
+        # "update" events with the category updated, or "*" for all, until the page is closed
+        queue = asyncio.Queue()
+        self.listeners.add(queue)
+        try:
+            self.write_head(writer, 200, {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}, False)
+            writer.write(b"retry: 1000\n\n")
+            await writer.drain()
+            while True:
+                try:
+                    category_name = await asyncio.wait_for(queue.get(), SERVE_KEEP_ALIVE)
+                    writer.write("event: update\ndata: {}\n\n".format(category_name).encode("utf-8"))
+                    self.counters["events sent"] += 1
+                except asyncio.TimeoutError:
+                    writer.write(b": keep-alive\n\n")  # also finds the streams of closed pages
+                await writer.drain()
+        finally:
+            self.listeners.discard(queue)
+
+    async def run(self, host, port, quiet_period=None):
+        # Serve until interrupted, watching the library unless quiet_period is None
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle, host, port)
+        print("+ Gallery served on http://{}:{}/".format(host, port))
+        print()
+        stop = self.bib.start_gallery_watch(quiet_period, write_files=False, on_update=self.updated, lock=self.lock) \
+            if quiet_period is not None else None
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if stop: stop()
+
+
+class NormalizationCache():
+    # main_parser and latex_encode results of single raw entries, keyed by the hash of the entry and evicted
+    # least recently used first. The entries are kept in SQLite and looked up one by one, so a command normalizing a few
+    # entries does not load the whole cache. Lookups and new results are written in one transaction by save
+    def __init__(self, file_path, max_entries):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.connection = None
+        self.clock = 0  # the last use of an entry, larger is more recent
+        self.used = {}  # {entry hash: use} of the entries found since the last save
+        self.pending = {}  # {entry hash: [key, parsed block, encoded block]} of the results put since the last save
+        self.hits, self.misses = 0, 0
+
+    def load(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            self.connection = sqlite3.connect(self.file_path, check_same_thread=False)
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (hash TEXT PRIMARY KEY, key TEXT, parsed TEXT, encoded TEXT,
+                    used INTEGER);
+                CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+            """)
+            self.clock = self.connection.execute("SELECT MAX(used) FROM entries").fetchone()[0] or 0
+
+    def get(self, entry_hash, encode):
+        # the (key, block) pair or None
+        record = self.pending.get(entry_hash)
+        if record is None:
+            record = self.connection.execute("SELECT key, parsed, encoded FROM entries WHERE hash = ?",
+                                             (entry_hash,)).fetchone()
+        if record is None or record[2 if encode else 1] is None:
+            self.misses += 1
+            return None
+        self.clock += 1
+        self.used[entry_hash] = self.clock
+        self.hits += 1
+        return record[0], record[2 if encode else 1]
+
+    def put(self, entry_hash, entry, encode):
+        if self.max_entries <= 0: return
+        key, block = entry
+        record = self.pending.setdefault(entry_hash, [key, None, None])
+        record[2 if encode else 1] = block
+        self.clock += 1
+        self.used[entry_hash] = self.clock
+
+    def save(self):
+        if not self.used and not self.pending: return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?) ON CONFLICT (hash) DO UPDATE SET "
+                "parsed = COALESCE(excluded.parsed, parsed), encoded = COALESCE(excluded.encoded, encoded), "
+                "used = excluded.used",
+                [(entry_hash, key, parsed, encoded, self.used[entry_hash])
+                 for entry_hash, (key, parsed, encoded) in self.pending.items()])
+            self.connection.executemany("UPDATE entries SET used = ? WHERE hash = ?",
+                                        [(used, entry_hash) for entry_hash, used in self.used.items()
+                                         if entry_hash not in self.pending])
+            count = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute("DELETE FROM entries WHERE hash IN "
+                                        "(SELECT hash FROM entries ORDER BY used LIMIT ?)", (count - self.max_entries,))
+        self.used, self.pending = {}, {}
+
+
+class TextIndex():
+    # Inverted index of the text of the PDFs, keyed by short code. The term counts of each PDF are kept with its
+    # fingerprint, so a PDF is only extracted again when it changed
+    k1, b = 1.2, 0.75  # BM25 parameters
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.documents = None  # {short code: {"category", "file", "fingerprint", "length", "terms": {term: count}}}
+        self.postings = None  # {term: {short code: count}}
+        self.changed = False
+
+    def load(self):
+        if self.documents is None:
+            records = load_pickle(self.file_path, {"documents": {}, "postings": {}})
+            self.documents, self.postings = records["documents"], records["postings"]
+
+    def remove(self, short_code):
+        document = self.documents.pop(short_code, None)
+        if document is None: return
+        for term in document["terms"]:
+            postings = self.postings[term]
+            del postings[short_code]
+            if not postings:
+                del self.postings[term]
+        self.changed = True
+
+    def add(self, short_code, category, file_name, fingerprint, terms):
+        self.remove(short_code)
+        self.documents[short_code] = {"category": category, "file": file_name, "fingerprint": fingerprint,
+                                      "length": sum(terms.values()), "terms": terms}
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[short_code] = count
+        self.changed = True
+
+    def idf(self, term):
+        n = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.documents) - n + 0.5) / (n + 0.5))
+
+    def search(self, query):
+        # (short code, score) ranked by BM25
+        if not self.documents: return []
+        average_length = sum(document["length"] for document in self.documents.values()) / len(self.documents)
+        scores = {}
+        for term in set(tokenize_text(query)):
+            idf = self.idf(term)
+            for short_code, count in self.postings.get(term, {}).items():
+                length = self.documents[short_code]["length"]
+                scores[short_code] = scores.get(short_code, 0) + idf * count * (self.k1 + 1) / (
+                        count + self.k1 * (1 - self.b + self.b * length / max(average_length, 1)))
+        return sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+
+    def top_terms(self, short_code, count):
+        # the terms weighted by tf-idf, as integer weights from 1 to 100
+        document = self.documents[short_code]
+        weights = {term: n / max(document["length"], 1) * self.idf(term) for term, n in document["terms"].items()}
+        top = sorted(weights.items(), key=lambda x: (-x[1], x[0]))[:count]
+        if not top: return []
+        return [(term, max(1, round(100 * weight / top[0][1])) if top[0][1] > 0 else 1) for term, weight in top]
+
+    def save(self):
+        if self.changed:
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            save_pickle(self.file_path, {"documents": self.documents, "postings": self.postings})
+            self.changed = False
+
+
+class ShortCodeRegistry():
+    # Every short code of the library with the sources holding it, a source being the .bib file ("bib", category) or
+    # the PDF folder ("folder", category) of a category. Short codes are looked up in an inverse index, and the short
+    # codes held by sources of more than one category are kept as collisions, so all lookups take constant time
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.sources = None  # {source: {"fingerprint": ..., "short_codes": {short code: [file names]}}}
+        self.index = None  # {short code: {source}}
+        self.collisions = None  # {short code}
+        self.changed = False
+
+    def load(self):
+        if self.sources is None:
+            self.sources = load_pickle(self.file_path, {"sources": {}})["sources"]
+            self.index, self.collisions = {}, set()
+            for source, record in self.sources.items():
+                for short_code in record["short_codes"]:
+                    self.index.setdefault(short_code, set()).add(source)
+            for short_code in self.index:
+                self.update_collision(short_code)
+
+    def update_collision(self, short_code):
+        if len(set(category for _, category in self.index.get(short_code, ()))) > 1:
+            self.collisions.add(short_code)
+        else:
+            self.collisions.discard(short_code)
+
+    def set_source(self, source, fingerprint, short_codes):
+        # Replace the short codes of a source, {short code: [file names]}, or remove the source if short_codes is None
+        previous = self.sources.pop(source, None)
+        for short_code in (previous["short_codes"] if previous else ()):
+            sources = self.index[short_code]
+            sources.discard(source)
+            if not sources:
+                del self.index[short_code]
+            self.update_collision(short_code)
+        if short_codes is not None:
+            self.sources[source] = {"fingerprint": fingerprint, "short_codes": short_codes}
+            for short_code in short_codes:
+                self.index.setdefault(short_code, set()).add(source)
+                self.update_collision(short_code)
+        self.changed = True
+
+    def add(self, source, short_code, file_name=None):
+        # A short code added by this process. The source is read again on the next update, in case it changed otherwise
+        record = self.sources.setdefault(source, {"fingerprint": None, "short_codes": {}})
+        record["fingerprint"] = None
+        file_names = record["short_codes"].setdefault(short_code, [])
+        if file_name is not None: file_names.append(file_name)
+        self.index.setdefault(short_code, set()).add(source)
+        self.update_collision(short_code)
+        self.changed = True
+
+    def rename(self, old, new, categories=None):
+        # Move a short code and its file names to a new short code in its sources, or in those of some categories
+        for source in self.index.get(old, set()).copy():
+            if categories is not None and source[1] not in categories: continue
+            record = self.sources[source]
+            record["fingerprint"] = None
+            file_names = record["short_codes"].pop(old)
+            record["short_codes"].setdefault(new, []).extend(new + file_name[len(old):] for file_name in file_names)
+            self.index[old].discard(source)
+            self.index.setdefault(new, set()).add(source)
+        if not self.index.get(old, True):
+            del self.index[old]
+        self.update_collision(old)
+        self.update_collision(new)
+        self.changed = True
+
+    def __contains__(self, short_code):
+        return short_code in self.index
+
+    def locations(self, short_code):
+        # {source: [file names]} of a short code
+        return {source: self.sources[source]["short_codes"][short_code] for source in self.index.get(short_code, ())}
+
+    def categories(self, short_code):
+        return set(category for _, category in self.index.get(short_code, ()))
+
+    def available(self, short_code, taken=()):
+        # The short code if it is free, otherwise the first free one with the suffix "-2", "-3", ... Short codes in
+        # taken, e.g. proposed but not collected yet, are not free either
+        candidate, number = short_code, 2
+        while candidate in self.index or candidate in taken:
+            candidate, number = short_code + "-" + str(number), number + 1
+        return candidate
+
+    def save(self):
+        if self.changed:
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            save_pickle(self.file_path, {"sources": self.sources})
+            self.changed = False
+
+
+class SQLiteCatalog():
+    # Entries, PDFs and pictures of the checked categories with indexed columns. Categories are only written again
+    # when their fingerprint changed since they were last synchronized
+    query_columns = ["short_code", "category", "theme", "year", "first_author", "entry_type"]
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            self.connection = sqlite3.connect(self.file_path, check_same_thread=False)
+            self.connection.row_factory = sqlite3.Row
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS categories (category TEXT PRIMARY KEY, fingerprint TEXT);
+                CREATE TABLE IF NOT EXISTS entries (short_code TEXT PRIMARY KEY, category TEXT, theme TEXT,
+                    year INTEGER, first_author TEXT, entry_type TEXT, title TEXT, bibtex_count INTEGER, bibtex TEXT);
+                CREATE TABLE IF NOT EXISTS files (file_name TEXT, category TEXT, short_code TEXT,
+                    PRIMARY KEY (category, file_name));
+                CREATE TABLE IF NOT EXISTS images (file_name TEXT, category TEXT, short_code TEXT,
+                    PRIMARY KEY (category, file_name));
+                CREATE INDEX IF NOT EXISTS entries_category ON entries (category);
+                CREATE INDEX IF NOT EXISTS entries_theme ON entries (theme);
+                CREATE INDEX IF NOT EXISTS entries_year ON entries (year);
+                CREATE INDEX IF NOT EXISTS entries_first_author ON entries (first_author);
+                CREATE INDEX IF NOT EXISTS entries_entry_type ON entries (entry_type);
+                CREATE INDEX IF NOT EXISTS files_short_code ON files (short_code);
+                CREATE INDEX IF NOT EXISTS images_short_code ON images (short_code);
+            """)
+        return self.connection
+
+    def synchronize(self, entry_store, fingerprints):
+        # fingerprints: {category: fingerprint string or None} of all checked categories, None always writes the
+        # category again. The rows of the other categories are removed. Returns the number of categories written
+        connection = self.connect()
+        known = dict(connection.execute("SELECT category, fingerprint FROM categories").fetchall())
+        changed = [category for category, fingerprint in fingerprints.items()
+                   if fingerprint is None or known.get(category) != fingerprint]
+        removed = [category for category in known if category not in fingerprints]
+        if not changed and not removed: return 0
+        with connection:
+            for category in removed:
+                for table in ["entries", "files", "images", "categories"]:
+                    connection.execute("DELETE FROM {} WHERE category = ?".format(table), (category,))
+            for category in changed:
+                for table in ["entries", "files", "images"]:
+                    connection.execute("DELETE FROM {} WHERE category = ?".format(table), (category,))
+                connection.execute("INSERT OR REPLACE INTO categories VALUES (?, ?)", (category, fingerprints[category]))
+            changed = set(changed)
+            entry_rows, file_rows, image_rows = [], [], []
+            for short_code, entry in entry_store.items():
+                if entry.category not in changed: continue
+                short_code = short_code.split("::")[-1]
+                author, year, _, _ = analyse_short_code(short_code)
+                entry_rows.append((short_code, entry.category, entry.theme, int(year) if year else None, author,
+                                   entry.type, entry.title, entry.b, entry.bibtex_string))
+                if entry.f is not None:
+                    file_rows.append((entry.f, entry.category, short_code))
+                image_rows += [(file_name, entry.category, short_code) for file_name in entry.pf]
+            connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", entry_rows)
+            connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", file_rows)
+            connection.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?)", image_rows)
+        return len(changed)
+
+    def query(self, has_pdf=None, has_images=None, has_bibtex=None, **conditions):
+        # rows of entries as dicts, with the PDF file name and the list of pictures
+        where, parameters = [], []
+        for column, value in conditions.items():
+            if column not in self.query_columns:
+                raise NameError("Cannot query by " + column + ", use one of " + ", ".join(self.query_columns))
+            where.append("e.{} = ?".format(column))
+            parameters.append(value)
+        for flag, clause in [(has_pdf, "EXISTS (SELECT 1 FROM files f WHERE f.short_code = e.short_code)"),
+                             (has_images, "EXISTS (SELECT 1 FROM images i WHERE i.short_code = e.short_code)"),
+                             (has_bibtex, "e.bibtex_count > 0")]:
+            if flag is not None:
+                where.append(clause if flag else "NOT " + clause)
+        # the PDF and the pictures are joined in the same statement, the pictures separated by "/" as no file name
+        # holds one
+        sql = "SELECT e.*, f.pdf, i.images FROM entries e" \
+              " LEFT JOIN (SELECT short_code, MIN(file_name) AS pdf FROM files GROUP BY short_code) f" \
+              " ON f.short_code = e.short_code" \
+              " LEFT JOIN (SELECT short_code, GROUP_CONCAT(file_name, '/') AS images FROM images GROUP BY short_code) i" \
+              " ON i.short_code = e.short_code" + (" WHERE " + " AND ".join(where) if where else "") + \
+              " ORDER BY e.category, e.theme, e.short_code"
+        rows = []
+        for row in self.connect().execute(sql, parameters).fetchall():
+            row = dict(row)
+            row["images"] = sorted(row["images"].split("/")) if row["images"] else []
+            rows.append(row)
+        return rows
+
+
+class Entry():
+    __slots__ = ["category", "theme", "type", "t", "b", "p", "title", "f", "pf", "link", "bibtex_string"]
+
+    def __init__(self, category, theme):
+        self.category = category
+        self.theme = theme
+        self.type = ""
+        self.t = ""
+        self.b = 0
+        self.p = 0
+        self.title = ""
+        self.f = None
+        self.pf = []
+        self.link = ""
+        self.bibtex_string = ""
+
+
+class EntryStore():
+    # Collects the entries of check in one pass, the DataFrame is built once from it
+    columns = ["Category", "Theme", "Type", "t", "B", "P", "Title", "f", "Pf", "Link", "BibtexString"]
+    attributes = list(Entry.__slots__)
+
+    def __init__(self):
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, short_code):
+        return short_code in self.entries
+
+    def __getitem__(self, short_code):
+        return self.entries[short_code]
+
+    def items(self):
+        return self.entries.items()
+
+    def add(self, category, short_code):
+        entry = self.entries.get(short_code)
+        if entry is None:
+            _, _, theme, _ = analyse_short_code(short_code)
+            entry = self.entries[short_code] = Entry(category, theme)
+        return entry
+
+    def select(self, **conditions):
+        # e.g. select(category="Robotics", type="book")
+        return {short_code: entry for short_code, entry in self.entries.items()
+                if all(getattr(entry, attribute) == value for attribute, value in conditions.items())}
+
+    def to_dataframe(self):
+        import pandas as pd
+        data = {column: [getattr(entry, attribute) for entry in self.entries.values()]
+                for column, attribute in zip(self.columns, self.attributes)}
+        return pd.DataFrame(data, index=list(self.entries.keys()), columns=self.columns, dtype=object)
+
+
 class Bib():
     def __init__(self, inspect_categories,
                  root_folder_path="",
@@ -84,7 +1313,13 @@ class Bib():
                  pdf_folder="PDF",
                  html_folder="Gallery",
                  pdf_collect_folder="to_collect",
-                 io_folder=""):
+                 io_folder="",
+                 cache_folder=".bibgallery",
+                 workers=1,
+                 normalization_cache_size=100000,
+                 sqlite_catalog=False,
+                 scan_threads=8,
+                 trace=False):
         self.root_folder_path = root_folder_path
         self.inspect_categories = inspect_categories
         self.additional_categories = additional_categories
@@ -94,90 +1329,342 @@ class Bib():
         self.html_path = os.path.join(root_folder_path, html_folder)
         self.pdf_collect_path = os.path.join(root_folder_path, pdf_collect_folder)
         self.io_path = os.path.join(root_folder_path, io_folder)
+        self.cache_path = os.path.join(root_folder_path, cache_folder)
+        self.manifest_file_path = os.path.join(self.cache_path, "manifest.json")
+        self.workers = workers
+        self.snapshot = LibrarySnapshot(self.bibtex_path, self.pdf_path, scan_threads)
+        self.normalization_cache = NormalizationCache(os.path.join(self.cache_path, "normalization_cache.sqlite"),
+                                                      normalization_cache_size)
+        self.entry_store = None  # filled by check
+        self.catalog_file_path = os.path.join(self.cache_path, "catalog.pickle")
+        self.catalog_df = None  # filled by check
+        self.sqlite_catalog = SQLiteCatalog(os.path.join(self.cache_path, "catalog.sqlite")) if sqlite_catalog else None
+        self.text_index = TextIndex(os.path.join(self.cache_path, "text_index.pickle"))
+        self.short_code_registry = ShortCodeRegistry(os.path.join(self.cache_path, "short_code_registry.pickle"))
+        self.instrumentation = Instrumentation(trace, os.path.join(self.cache_path, "trace.json"))
+        # in-memory index of the gallery, filled by generate_html_files and updated by gallery_update
+        self.gallery_df = None
+        self.gallery_thumbnails = {}
+        self.gallery_page_hashes = {}
+        self.gallery_options = {}
+        self.gallery_watch_counters = {"events": 0, "category rebuilds": 0, "full rebuilds": 0}
 
         if os.path.isabs(root_folder_path):
             self.root_folder_path_absolute = self.root_folder_path
         else:
             self.root_folder_path_absolute = pathlib.Path(os.path.realpath(__file__)).parent.absolute()
-        # pdf2bib.config.set('save_identifier_metadata', False)
-        pdf2bib.config.set('verbose', False)
-
-    def check(self, update_bibtex=None, show_incomplete=True, check_books=False):
-
-        def new_short_code(df, category, string):
-            if debug_switch: print("short_code: ", string)
-            _, _, theme, _ = analyse_short_code(string)
-            return pd.concat([df, pd.DataFrame({"Category": [category],
-                                                "Theme": [theme],
-                                                "Title": [""],
-                                                "t": [""],
-                                                "Type": [""],
-                                                "B": [0],
-                                                "P": [0],
-                                                "f": [None],
-                                                "Pf": [[]],
-                                                "Link": [""],
-                                                "BibtexString": [""]}, index=[string])])
+
+    def load_manifest(self):
+        manifest = load_json(self.manifest_file_path, {})
+        for section in ["bib", "folder"]:
+            manifest.setdefault(section, {})
+        return manifest
+
+    def save_manifest(self, manifest):
+        if not os.path.exists(self.cache_path): os.makedirs(self.cache_path)
+        save_json(self.manifest_file_path, manifest)
+
+    def scan(self):
+        # The listings of the .bib and PDF folders, listing again only the folders that changed since the last scan
+        return self.snapshot.refresh()
+
+    def query(self, has_pdf=None, has_images=None, has_bibtex=None, **conditions):
+        # e.g. query(first_author="Akbarzadeh", year=2019, has_images=False)
+        if self.sqlite_catalog is None:
+            raise NameError("Queries need the SQLite catalog, set up Bib with sqlite_catalog=True and run Bib.check")
+        return self.sqlite_catalog.query(has_pdf=has_pdf, has_images=has_images, has_bibtex=has_bibtex, **conditions)
+
+    @traced
+    def update_text_index(self, df=None):
+        # Extract the text of the PDFs that are new or changed since they were last indexed (in a process pool if
+        # workers > 1), and drop the PDFs that are gone
+        print("[UPDATE TEXT INDEX]")
+        if df is None:
+            df = self.load_catalog()
+        text_index = self.text_index
+        text_index.load()
+        pdf_files = {short_code: (category_name, pdf_file) for short_code, category_name, pdf_file in
+                     zip(df.index, df["Category"], df["f"])
+                     if isinstance(pdf_file, str) and category_name in self.inspect_categories}
+        for short_code in list(text_index.documents.keys()):
+            if short_code not in pdf_files:
+                text_index.remove(short_code)
+        jobs = []
+        for short_code, (category_name, pdf_file) in pdf_files.items():
+            pdf_file_path = os.path.join(self.pdf_path, category_name, pdf_file)
+            if not os.path.isfile(pdf_file_path): continue
+            document = text_index.documents.get(short_code)
+            previous = document["fingerprint"] if document and document["file"] == pdf_file else None
+            fingerprint = file_fingerprint(pdf_file_path, previous)
+            if fingerprint is previous:
+                continue
+            if same_fingerprint(previous, fingerprint) and document["category"] == category_name:
+                document["fingerprint"] = fingerprint
+                text_index.changed = True
+                continue
+            jobs.append((short_code, category_name, pdf_file, fingerprint, pdf_file_path))
+        extracted = self.map_in_pool(extract_pdf_terms, [job[-1] for job in jobs])
+        for (short_code, category_name, pdf_file, fingerprint, pdf_file_path), terms in zip(jobs, extracted):
+            if terms is None:
+                print("- Cannot read the text of '" + pdf_file_path + "'")
+                terms = {}
+            text_index.add(short_code, category_name, pdf_file, fingerprint, terms)
+        text_index.save()
+        print("+ Text of", len(jobs), "PDFs indexed,", len(text_index.documents), "PDFs in the index")
+        print()
+
+    def search(self, query, limit=20):
+        # rows of the PDFs best matching the query, as dicts with the score. Uses the index of Bib.update_text_index
+        self.text_index.load()
+        rows = []
+        for short_code, score in self.text_index.search(query)[:limit]:
+            document = self.text_index.documents[short_code]
+            rows.append({"short_code": short_code, "category": document["category"], "pdf": document["file"],
+                         "score": score})
+        return rows
+
+    def search_index_script(self, terms_per_document=100, file_url=None):
+        # The top terms of each PDF for the search box of the gallery, loaded by the pages as a script.
+        # file_url(category_name, file_name) gives the links to the PDFs, absolute file paths by default
+        text_index = self.text_index
+        text_index.load()
+        documents, terms = [], {}
+        for short_code in sorted(text_index.documents):
+            document = text_index.documents[short_code]
+            if document["category"] not in self.inspect_categories: continue
+            if file_url is None:
+                href = '{}/{}'.format(os.path.join(self.root_folder_path_absolute, self.pdf_path, document["category"])
+                                      .replace('\\', '/'), document["file"])
+            else:
+                href = file_url(document["category"], document["file"])
+            title = document["file"].rsplit(".", 1)[0].split(" ", 1)[-1]
+            for term, weight in text_index.top_terms(short_code, terms_per_document):
+                terms.setdefault(term, []).extend([len(documents), weight])
+            documents.append([short_code, document["category"], title, href])
+        return "var SEARCH_INDEX = " + json.dumps({"documents": documents, "terms": terms}, ensure_ascii=False,
+                                                  separators=(",", ":"), sort_keys=True) + ";\n"
+
+    def write_search_index(self, terms_per_document=100):
+        write_if_changed(os.path.join(self.html_path, "search_index.js"), self.search_index_script(terms_per_document))
+
+    def save_catalog(self, df):
+        # Typed handoff from check to generate_html_files, keeping the lists of pictures as lists
+        if not os.path.exists(self.cache_path): os.makedirs(self.cache_path)
+        save_pickle(self.catalog_file_path, {"schema_version": CATALOG_SCHEMA_VERSION,
+                                             "index": list(df.index),
+                                             "columns": {column: list(df[column]) for column in df.columns}})
+
+    def load_catalog(self):
+        # The table of the last check, from memory if it ran in this process
+        if self.catalog_df is not None:
+            return self.catalog_df.copy()
+        catalog = load_pickle(self.catalog_file_path, None)
+        if catalog is None or catalog.get("schema_version") != CATALOG_SCHEMA_VERSION:
+            raise NameError("No catalog of the current version in " + self.catalog_file_path + ", run Bib.check first")
+        import pandas as pd
+        return pd.DataFrame(catalog["columns"], index=catalog["index"], columns=list(catalog["columns"].keys()),
+                            dtype=object)
+
+    def transform_bibtex_strings(self, bibtex_strings, encode=False):
+        # main_parser (or latex_encode) of each string, computed entry by entry. Entries found in the normalization
+        # cache are reused, the others are parsed in chunks (in a process pool if workers > 1) and merged in order.
+        # Strings with comments, @string blocks or duplicate keys fall back to the whole-string function
+        transform = latex_encode if encode else main_parser
+        cache = self.normalization_cache
+        cache.load()
+        hits, misses = cache.hits, cache.misses
+        plans, tasks = [], []
+        for bibtex_string in bibtex_strings:
+            raw_entries = [raw_entry.strip() for raw_entry in split_bibtex_string(bibtex_string, 1)]
+            entry_hashes = [hash_string(raw_entry) for raw_entry in raw_entries]
+            cached_entries = [cache.get(entry_hash, encode) for entry_hash in entry_hashes]
+            missing_entries = [raw_entry for raw_entry, cached_entry in zip(raw_entries, cached_entries)
+                               if cached_entry is None]
+            first_task = len(tasks)
+            for i in range(0, len(missing_entries), PARALLEL_CHUNK_ENTRIES):
+                tasks.append("\n\n".join(missing_entries[i:i + PARALLEL_CHUNK_ENTRIES]))
+            plans.append((entry_hashes, cached_entries, len(missing_entries), first_task, len(tasks)))
+
+        task_results = self.map_in_pool(normalize_entries, tasks, [encode] * len(tasks))
+
+        results, fallbacks = [], []
+        for bibtex_string, (entry_hashes, cached_entries, count_missing, first_task, last_task) in zip(
+                bibtex_strings, plans):
+            new_entries = task_results[first_task:last_task]
+            if None in new_entries or sum(len(task_entries) for task_entries in new_entries) != count_missing:
+                fallbacks.append(len(results))
+                results.append(bibtex_string)
+                continue
+            new_entries = iter([entry for task_entries in new_entries for entry in task_entries])
+            entries = []
+            for entry_hash, cached_entry in zip(entry_hashes, cached_entries):
+                if cached_entry is None:
+                    cached_entry = next(new_entries)
+                    cache.put(entry_hash, cached_entry, encode)
+                entries.append(cached_entry)
+            if len(set(key for key, _ in entries)) < len(entries):
+                fallbacks.append(len(results))
+                results.append(bibtex_string)
+            elif encode:
+                results.append("\n\n".join(block for _, block in entries))
+            else:
+                results.append("\n\n".join(block for _, block in sorted(entries, key=lambda x: x[0])))
+
+        for i, result in zip(fallbacks, self.map_in_pool(transform, [results[i] for i in fallbacks])):
+            results[i] = result
+        cache.save()
+        trace_count("cache hits", cache.hits - hits)
+        trace_count("entries parsed", cache.misses - misses)
+        trace_count("fallbacks", len(fallbacks))
+        return results
+
+    def map_in_pool(self, function, *iterables):
+        # map over a process pool when workers > 1, results are in the order of the arguments
+        arguments = list(zip(*iterables))
+        if self.workers <= 1 or len(arguments) <= 1:
+            return [function(*argument) for argument in arguments]
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(function, *zip(*arguments)))
+
+    def parse_bibtex(self, bibtex_string):
+        return self.transform_bibtex_strings([bibtex_string])[0]
+
+    def encode_bibtex(self, bibtex_string):
+        return self.transform_bibtex_strings([bibtex_string], encode=True)[0]
+
+    @traced
+    def check(self, update_bibtex=None, show_incomplete=True, check_books=False, incremental=True, reports=None,
+              report_columns=None):
 
         print("[CHECK]")
-        df = pd.DataFrame(columns=["Category", "Theme", "Type", "t", "B", "P", "Title", "f", "Pf", "Link"])
-        debug_switch = False
+        reports = list(CHECK_REPORTS) if reports is None else reports
+        report_columns = REPORT_COLUMNS if report_columns is None else report_columns
+        for name in reports:
+            if name not in CHECK_REPORTS:
+                raise NameError("Unknown report " + name + ", use one of " + ", ".join(CHECK_REPORTS))
+        for column in report_columns:
+            if column not in EntryStore.columns:
+                raise NameError("Unknown report column " + column + ", use some of " + ", ".join(EntryStore.columns))
+        # short codes held by two checked categories are found in the registry, before anything is parsed
+        trace_phase("scan")
+        snapshot = self.scan()
+        trace_phase("short codes")
+        registry = self.update_short_code_registry(snapshot)
+        collisions = [short_code for short_code in sorted(registry.collisions)
+                      if len(registry.categories(short_code).intersection(self.inspect_categories)) > 1]
+        if collisions:
+            print("Colliding short codes:")
+            for short_code in collisions:
+                print("  " + short_code + ":", ", ".join(kind + " of " + category for kind, category in
+                                                        sorted(registry.locations(short_code))))
+            raise NameError("Above short code collision detected in the library")
+
+        trace_phase("read bibtex")
+        entry_store = EntryStore()
 
         update_bibtex_flag = update_bibtex is not None
-        for category_file in os.listdir(self.bibtex_path):
+        # Categories whose .bib file and PDF folder listing match the manifest are merged from the cache
+        manifest = self.load_manifest() if incremental else {"bib": {}, "folder": {}}
+        check_cache_file_path = os.path.join(self.cache_path, "check_cache.pickle")
+        check_cache = load_pickle(check_cache_file_path, {}) if incremental else {}
+        count_parsed, count_listed = 0, 0
+        category_names, original_bibtex_strings = [], {}
+        for category_file in snapshot.bib_files:
             bibtex_file_path = os.path.join(self.bibtex_path, category_file)
-            if os.path.isfile(bibtex_file_path):
-                category_name = category_file[:-4]
-                if category_name not in self.inspect_categories: continue
-                # print("- Inspecting category: ", category_name)
-
-                # 1. Import, format and sort the BibTeX entries
+            category_name = category_file[:-4]
+            if category_name not in self.inspect_categories: continue
+            category_names.append(category_name)
+            category_cache = check_cache.setdefault(category_name, {})
+            bib_fingerprint = snapshot.bibtex_file_fingerprint(category_name, manifest["bib"].get(category_name))
+            if "entries" in category_cache and same_fingerprint(manifest["bib"].get(category_name), bib_fingerprint):
+                manifest["bib"][category_name] = bib_fingerprint
+            else:
+                # 1. Import the BibTeX entries
                 with codecs.open(bibtex_file_path, "r", "utf-8") as file:
-                    bibtex_string = file.read()
-                bibtex_string = main_parser(bibtex_string)
-
-                # 3. Write the sorted BibTeX entries to a new file
-                with codecs.open(bibtex_file_path, 'w', "utf-8") as file:
-                    file.write(bibtex_string)
+                    original_bibtex_strings[category_name] = file.read()
+                trace_count("files read")
+
+        # 2. Format and sort the BibTeX entries, in a process pool if workers > 1
+        trace_phase("parse bibtex")
+        parsed_bibtex_strings = dict(zip(original_bibtex_strings.keys(),
+                                         self.transform_bibtex_strings(list(original_bibtex_strings.values()))))
+
+        trace_phase("import entries")
+        for category_name in category_names:
+            # print("- Inspecting category: ", category_name)
+            bibtex_file_path = os.path.join(self.bibtex_path, category_name + ".bib")
+            category_cache = check_cache[category_name]
+            if category_name not in parsed_bibtex_strings:
+                entries = category_cache["entries"]
+            else:
+                bibtex_string = parsed_bibtex_strings[category_name]
 
-                # 4. Import literature from pdf/image files into DataFrame
-                category_path = os.path.join(self.pdf_path, category_name)
-                for file_name in os.listdir(category_path):
-                    if os.path.isfile(os.path.join(category_path, file_name)):
-                        name, file_type = file_name.rsplit(".", 1)
-                        short_code, title = name.split(" ", 1)
-                        short_code = category_name + "::" + short_code
-
-                        if short_code not in df.index:
-                            df = new_short_code(df, category_name, short_code)
-                            df.loc[short_code, "Title"] = title
-                        if file_type.lower() == "pdf":
-                            df.loc[short_code, "Link"] = "[](<" + os.path.join(category_path,
-                                                                               file_name) + ">)"
-                            df.loc[short_code, "f"] = file_name
-                        if file_type.lower() in ["jpg", "png"]:
-                            df.loc[short_code, "P"] += 1
-                            df.loc[short_code, "Pf"].append(file_name)
-
-                # 5. Import literature from bibtex files into DataFrame
-                with codecs.open(bibtex_file_path, "r", "utf-8") as file:
-                    bibtex_string = file.read()
+                # 3. Write the sorted BibTeX entries to a new file, if they changed
+                if bibtex_string != original_bibtex_strings[category_name]:
+                    with BibtexEntryWriter(bibtex_file_path) as writer:
+                        writer.write(bibtex_string)
                 entries = bibtex_string.split('\n\n\n')
-                for entry in entries:
-                    bib_type, short_code = entry.split("{", 1)
-                    short_code = short_code.split(",", 1)[0]
-                    short_code = category_name + "::" + short_code
-                    if short_code not in df.index:
-                        df = new_short_code(df, category_name, short_code)
-                    df.loc[short_code, "Type"] = bib_type[1:]
-                    df.loc[short_code, "B"] += 1
-                    # if update_bibtex_flag:
-                    df.loc[short_code, "BibtexString"] = entry
-
+                category_cache["entries"] = entries
+                count_parsed += 1
+                # Only a file that is already in the parsed form can be skipped next time
+                if bibtex_string == original_bibtex_strings[category_name]:
+                    manifest["bib"][category_name] = file_fingerprint(bibtex_file_path)
+                else:
+                    manifest["bib"].pop(category_name, None)
+
+            # 4. Import literature from pdf/image files into DataFrame
+            category_path = os.path.join(self.pdf_path, category_name)
+            folder_fingerprint_new, file_names = snapshot.folder_fingerprint(category_name,
+                                                                             manifest["folder"].get(category_name))
+            if file_names is None and "file_names" in category_cache:
+                file_names = category_cache["file_names"]
+            else:
+                if file_names is None:
+                    folder_fingerprint_new, file_names = snapshot.folder_fingerprint(category_name)
+                category_cache["file_names"] = file_names
+                count_listed += 1
+                trace_count("folders listed")
+            manifest["folder"][category_name] = folder_fingerprint_new
+            trace_count("files scanned", len(file_names))
+            for file_name in file_names:
+                name, file_type = file_name.rsplit(".", 1)
+                short_code, title = name.split(" ", 1)
+                short_code = category_name + "::" + short_code
+
+                if short_code not in entry_store:
+                    entry_store.add(category_name, short_code).title = title
+                item = entry_store[short_code]
+                if file_type.lower() == "pdf":
+                    item.link = "[](<" + os.path.join(category_path, file_name) + ">)"
+                    item.f = file_name
+                if file_type.lower() in ["jpg", "png"]:
+                    item.p += 1
+                    item.pf.append(file_name)
+
+            # 5. Import literature from bibtex files into the entry store
+            for entry in entries:
+                bib_type, short_code = entry.split("{", 1)
+                short_code = short_code.split(",", 1)[0]
+                short_code = category_name + "::" + short_code
+                item = entry_store.add(category_name, short_code)
+                item.type = bib_type[1:]
+                item.b += 1
+                # if update_bibtex_flag:
+                item.bibtex_string = entry
+
+        self.save_manifest(manifest)
+        save_pickle(check_cache_file_path, check_cache)
+
+        trace_count("entries", len(entry_store))
+        trace_phase("dataframe")
+        self.entry_store = entry_store
+        df = entry_store.to_dataframe()
         print("+ Bib/PDF/Image imported into the DataFrame")
         print("+ Bibtex files updated in", self.bibtex_path)
+        print("+ Categories parsed:", count_parsed, " folders listed:", count_listed)
 
         # df display options
+        import pandas as pd
         pd.set_option('display.max_columns', None)
         pd.set_option('display.max_rows', None)
         pd.set_option('display.max_colwidth', None)
@@ -199,19 +1686,21 @@ class Bib():
             raise NameError("Above short code collision detected in the DataFrame")
 
         # update_bibtex
+        updated_categories = set()
         if update_bibtex_flag:
-            updated_categories = set()
+            trace_phase("update bibtex")
             print('+ Update bibtex in {}'.format(update_bibtex))
             update_bibtex_file_path = os.path.join(self.io_path, update_bibtex)
             with codecs.open(update_bibtex_file_path, "r", "utf-8") as file:
                 bibtex_string = file.read()
-            bibtex_string = main_parser(bibtex_string).split("\n\n\n")
+            bibtex_string = self.parse_bibtex(bibtex_string).split("\n\n\n")
             for item in bibtex_string:
                 if item[0] != "@": continue
                 itembib = analyze_bibtex_single_item(item)
                 if itembib.key in df.index:
                     # print(df.loc[itembib.key, "BibtexString"])
                     df.loc[itembib.key, "BibtexString"] = item
+                    entry_store[df.loc[itembib.key, "Category"] + "::" + itembib.key].bibtex_string = item
                     print("  + {} updated in {}".format(itembib.key, df.loc[itembib.key, "Category"]))
                     updated_categories.add(df.loc[itembib.key, "Category"])
                 else:
@@ -221,14 +1710,24 @@ class Bib():
                 bibtex_string = '\n\n\n'.join(df[df["Category"] == category_name]["BibtexString"].tolist())
                 with codecs.open(bibtex_file_path, 'w', "utf-8") as file:
                     file.write(bibtex_string)
+                trace_written(bibtex_file_path)
             print('+ Bibtex in {} updated'.format(update_bibtex))
 
+        if self.sqlite_catalog:
+            # after update_bibtex, whose categories are written again as their .bib files changed since the manifest
+            trace_phase("sqlite catalog")
+            fingerprints = {}
+            for category_name in category_names:
+                bib_fingerprint = manifest["bib"].get(category_name)
+                fingerprints[category_name] = None if bib_fingerprint is None or category_name in updated_categories \
+                    else bib_fingerprint["hash"] + manifest["folder"][category_name]["hash"]
+            print("+ SQLite catalog updated for", self.sqlite_catalog.synchronize(entry_store, fingerprints),
+                  "categories")
+
+        trace_phase("reports")
         df = df.sort_values(by=['Category', 'Theme'], ascending=[True, True])
         df.loc[(df["B"] > 0) & (df["Link"] != "") & (df["P"] > 0), "t"] = "t"
 
-        def title_shorter(x):
-            return x[:47] + "..." if len(x) > 50 else x
-
         df['Title'] = df['Title'].apply(title_shorter)
         max_link_len = max(df['Link'].apply(lambda x: len(x)))
         df['Link'] = df['Link'].apply(lambda x: x.ljust(max_link_len))
@@ -238,12 +1737,13 @@ class Bib():
         #     print(df)
         #     print()
 
-        # Print results to Markdown
-        df_nobibtex = df.drop(columns=['BibtexString'])
-        print(df_nobibtex, file=codecs.open(os.path.join(self.io_path, 'BibCheckResultAll.md'), 'w', 'utf-8'))
-        print(df_nobibtex[df_nobibtex["Type"] != "book"],
-              file=codecs.open(os.path.join(self.io_path, 'BibCheckResultNonBooks.md'), 'w', 'utf-8'))
-        print('+ DataFrame updated as', os.path.join(self.io_path, 'BibCheckResultAll.md'))
+        # Write results to Markdown
+        if "all" in reports:
+            write_table_report(os.path.join(self.io_path, CHECK_REPORTS["all"]), df, report_columns)
+            print('+ DataFrame updated as', os.path.join(self.io_path, CHECK_REPORTS["all"]))
+        if "non_books" in reports:
+            write_table_report(os.path.join(self.io_path, CHECK_REPORTS["non_books"]), df[df["Type"] != "book"],
+                               report_columns)
 
         problem_non_book_df = df[
             ((df["B"] != 1) | (df["Link"] == "") | (df["P"] == 0)) & (df["Type"] != "misc") & (
@@ -263,39 +1763,155 @@ class Bib():
         print("+ Number of all entries:", len(df))
         print("+ Number of incomplete entries:", len(problem_non_book_df), "non-books and", len(problem_book_df),
               "books")
-        df.to_csv(os.path.join(self.io_path, 'BibCheckResultAll.csv'))
-        print("+ Results saved in", os.path.join(self.io_path, 'BibCheckResultAll.csv'))
+        self.catalog_df = df
+        self.save_catalog(df)
+        if "csv" in reports:
+            csv_file_path = os.path.join(self.io_path, CHECK_REPORTS["csv"])
+            with open(csv_file_path, "w", encoding="utf-8", newline="") as file:
+                df.to_csv(file, columns=report_columns, chunksize=REPORT_CHUNK_ROWS)
+            trace_written(csv_file_path)
+            print("+ Results saved in", csv_file_path)
         print()
         # unique_values = df['Category'].unique()
 
+    @traced
     def update_latex(self):
+        # Categories whose .bib file and output are unchanged since the last run are skipped, by the fingerprints kept
+        # in latex_sources.json next to the outputs. In the other categories, the entries found in the normalization
+        # cache are not encoded again. Outputs are replaced atomically, and only if their content changes
         print("[UPDATE LATEX]")
+        trace_phase("scan")
+        snapshot = self.scan()
+        trace_phase("read bibtex")
         if not os.path.exists(self.bibtex_latex_path):
             os.makedirs(self.bibtex_latex_path)
-        for category_file in os.listdir(self.bibtex_path):
+        sources_file_path = os.path.join(self.bibtex_latex_path, "latex_sources.json")
+        sources = load_json(sources_file_path, {})
+        new_sources = {}
+        bibtex_strings = {}
+        count_unchanged = 0
+        for category_file in snapshot.bib_files:
             bibtex_file_path = os.path.join(self.bibtex_path, category_file)
-            if os.path.isfile(bibtex_file_path):
-                if category_file[-4:] != ".bib": continue
-                category_name = category_file[:-4]
-                if not (
-                        category_name in self.inspect_categories or category_name in self.additional_categories): continue
-
-                with codecs.open(bibtex_file_path, "r", "utf-8") as file:
-                    bibtex_string = file.read()
-                bibtex_string = latex_encode(bibtex_string)
-
-                # 3. Write the sorted BibTeX entries to a new file
-                bibtex_latex_file_path = os.path.join(self.bibtex_latex_path, category_name + "_latex.bib")
-                with codecs.open(bibtex_latex_file_path, 'w', "utf-8") as file:
-                    file.write(bibtex_string)
+            if category_file[-4:] != ".bib": continue
+            category_name = category_file[:-4]
+            if not (category_name in self.inspect_categories or category_name in self.additional_categories): continue
+
+            previous = sources.get(category_name, {})
+            source = snapshot.bibtex_file_fingerprint(category_name, previous.get("source"))
+            bibtex_latex_file_path = os.path.join(self.bibtex_latex_path, category_name + "_latex.bib")
+            if same_fingerprint(previous.get("source"), source) and os.path.isfile(bibtex_latex_file_path):
+                output = file_fingerprint(bibtex_latex_file_path, previous.get("output"))
+                if same_fingerprint(previous.get("output"), output):
+                    new_sources[category_name] = {"source": source, "output": output}
+                    count_unchanged += 1
+                    trace_count("categories unchanged")
+                    continue
+            new_sources[category_name] = {"source": source}
+            with codecs.open(bibtex_file_path, "r", "utf-8") as file:
+                bibtex_strings[category_name] = file.read()
+            trace_count("files read")
+
+        trace_phase("encode bibtex")
+        latex_bibtex_strings = self.transform_bibtex_strings(list(bibtex_strings.values()), encode=True)
+        trace_phase("write")
+        for category_name, bibtex_string in zip(bibtex_strings.keys(), latex_bibtex_strings):
+            # 3. Write the sorted BibTeX entries to a new file
+            bibtex_latex_file_path = os.path.join(self.bibtex_latex_path, category_name + "_latex.bib")
+            write_if_changed(bibtex_latex_file_path, bibtex_string)
+            new_sources[category_name]["output"] = file_fingerprint(bibtex_latex_file_path)
+        if new_sources != sources:
+            save_json(sources_file_path, new_sources)
 
         print("+ Bibtex (latex) files updated in", self.bibtex_latex_path)
+        print("+ Categories encoded:", len(bibtex_strings), " unchanged:", count_unchanged)
         print()
 
-    def generate_html_files(self):
-
-        def generate_html(df, category_name):
-            html_A = '''<html>
+    def update_gallery(self, categories=None):
+        # Fill the in-memory index of the gallery from the catalog of the last check, or update the thumbnails of the
+        # given categories in it, with the options of the last Bib.generate_html_files or Bib.serve. Returns the
+        # categories updated
+        if categories is None or self.gallery_df is None:
+            categories = self.inspect_categories
+            df = self.load_catalog()
+            df["Pf"] = df["Pf"].apply(list)  # the gallery updates its own copy
+            self.gallery_df, self.gallery_thumbnails = df, {}
+        if self.gallery_options["thumbnail_height"]:
+            trace_phase("thumbnails")
+            self.gallery_thumbnails.update(self.generate_thumbnails(self.gallery_df, categories))
+        self.html_file_path_dict = {category_name: category_name + '.html' for category_name in self.inspect_categories}
+        return categories
+
+    def generate_thumbnails(self, df, categories):
+        # (category, file name) -> (url relative to the HTML files, width, height, source mtime) of the thumbnails of
+        # all pictures, and the first-page previews of the PDFs without pictures. The sizes of the thumbnails on disk
+        # are kept in thumbnails.json, so an up to date thumbnail is neither rendered nor opened again
+        thumbnail_height = self.gallery_options["thumbnail_height"]
+        manifest_file_path = os.path.join(self.html_path, "thumbnails", "thumbnails.json")
+        # "category/file name" -> [width, height, source mtime, thumbnail height]
+        manifest = load_json(manifest_file_path, {})
+        manifest_changed = False
+
+        def url(category_name, file_name):
+            return "thumbnails/{}/{}".format(urllib.parse.quote(category_name), urllib.parse.quote(file_name + ".jpg"))
+
+        jobs = {}
+        thumbnails = {}
+        for category_name in categories:
+            thumbnail_folder_path = os.path.join(self.html_path, "thumbnails", category_name)
+            existing = os.listdir(thumbnail_folder_path) if os.path.exists(thumbnail_folder_path) else []
+            expected = set()
+            category_df = df[df["Category"] == category_name]
+            for pdf_file, pictures in zip(category_df["f"], category_df["Pf"]):
+                file_names = list(pictures)
+                if not file_names and isinstance(pdf_file, str):
+                    file_names = [pdf_file]
+                for file_name in file_names:
+                    expected.add(file_name + ".jpg")
+                    source_path = os.path.join(self.pdf_path, category_name, file_name)
+                    try:
+                        source_mtime = os.stat(source_path).st_mtime_ns
+                    except FileNotFoundError:
+                        source_mtime = None
+                    known = self.gallery_thumbnails.get((category_name, file_name))
+                    if known and source_mtime == known[3]:
+                        continue
+                    record = manifest.get(category_name + "/" + file_name)
+                    if record and record[2:] == [source_mtime, thumbnail_height] and file_name + ".jpg" in existing:
+                        thumbnails[(category_name, file_name)] = (url(category_name, file_name), record[0], record[1],
+                                                                  source_mtime)
+                        continue
+                    jobs[(category_name, file_name)] = (source_path,
+                                                        os.path.join(thumbnail_folder_path, file_name + ".jpg"))
+            # remove the thumbnails of renamed or deleted files
+            for file_name in existing:
+                if file_name not in expected:
+                    os.remove(os.path.join(thumbnail_folder_path, file_name))
+                    manifest_changed = manifest.pop(category_name + "/" + file_name[:-4], None) is not None or \
+                        manifest_changed
+
+        with ThreadPoolExecutor(max_workers=self.gallery_options["thumbnail_threads"]) as executor:
+            results = map_counted(executor, lambda job: make_thumbnail(job[0], job[1], thumbnail_height),
+                                  jobs.values())
+        for (category_name, file_name), result in zip(jobs.keys(), results):
+            manifest_changed = True
+            if result:
+                thumbnails[(category_name, file_name)] = (url(category_name, file_name),) + result
+                manifest[category_name + "/" + file_name] = list(result[:2]) + [result[2], thumbnail_height]
+            else:
+                manifest.pop(category_name + "/" + file_name, None)
+        if manifest_changed:
+            os.makedirs(os.path.dirname(manifest_file_path), exist_ok=True)
+            save_json(manifest_file_path, manifest)
+        trace_count("thumbnails rendered", len(jobs))
+        print("+ Thumbnails of", len(thumbnails), "files updated in", os.path.join(self.html_path, "thumbnails"))
+        return thumbnails
+
+    def render_gallery_pages(self, category_name, theme=None, file_url=None, live_reload=False):
+        # (file name, HTML pieces) of the pages of a category, rendered from the in-memory index of the gallery. With a
+        # theme, only the entries of that theme, on the page that holds them. file_url(category_name, file_name) gives
+        # the links to the PDFs and pictures, absolute file paths by default. With live_reload, the page reloads when
+        # the events of Bib.serve report an update of its category
+        html_A = '''<html>
 <head>
     <link href="https://fonts.googleapis.com/css2?family=Source+Serif+4:ital,opsz,wght@0,8..60,200..900;1,8..60,200..900&display=swap" rel="stylesheet">
     <style>
@@ -314,6 +1930,12 @@ class Bib():
         
         .image img {
             max-height: 100%;
+            width: auto;
+        }
+
+        .pages {
+            font-family: "Source Serif 4", serif;
+            margin: 7.5px;
         }
         
         .title-box {
@@ -362,345 +1984,1233 @@ class Bib():
 <body>
 
 <div class="sidenav">'''
-            html_B = '''
+        html_B = '''
 </div>
 
 
 <div class="main">
 '''
-            html_C = '''
+        html_C = '''
 </div>
 </body>
 </html>'''
-
-            html_main = ""
-            html_navbar_main = ""
-            folder_path_absolute = os.path.join(self.root_folder_path_absolute, self.pdf_path, category_name).replace(
-                '\\', '/')
-            df = df[df["Category"] == category_name]
-            theme_i = list(df.columns).index("Theme")
-            title_i = list(df.columns).index("Title")
-            file_i = list(df.columns).index("f")
-            pictures_i = list(df.columns).index("Pf")
-            isna = df.isna()
-            placeholder = "https://upload.wikimedia.org/wikipedia/commons/thumb/8/87/PDF_file_icon.svg/195px-PDF_file_icon.svg.png"
-            for row_i, (index, row) in enumerate(df.iterrows()):
-                if (row_i == 0) or (df.iloc[row_i, theme_i] != df.iloc[row_i - 1, theme_i]):
-                    theme_text = df.iloc[row_i, theme_i].replace("-", " ")
-                    html_main += '<h1 id="{}">{}</h1>\n'.format(df.iloc[row_i, theme_i], theme_text)
-                    html_navbar_main += '<h3><a style="padding-left: 60px" href="#{}">{}</a></h3>\n'.format(
-                        df.iloc[row_i, theme_i], theme_text)
-                if isna.iloc[row_i, file_i]:
-                    file = None
-                    html_main += '<div class="title-box"><h4>{}</h4></div>'.format(index)
-                else:
-                    text = '{} {}'.format(index, df.iloc[row_i, title_i])
-                    file = '{}/{}'.format(folder_path_absolute, df.iloc[row_i, file_i])
-                    html_main += '<div class="title-box"><h4><a href = "{}">{}</a></h4></div>\n'.format(
-                        file, text)
-                if len(df.iloc[row_i, pictures_i]) <= 4:
-                    if file:
-                        html_main += '<div class="image"><a href="{}"><img src="{}" alt="placeholder"></a></div>\n'.format(
-                            file, placeholder)
-                else:
-                    pictures_list = df.iloc[row_i, pictures_i][2:-2].split("', '")
-                    for picture in pictures_list:
-                        if file:
-                            html_main += '<div class="image"><a href="{}"><img src="file:///{}/{}" alt="{}"></a></div>\n'.format(
-                                file, folder_path_absolute, picture, picture)
-                        else:
-                            html_main += '<div class="image"><img src="file:///{}/{}" alt="{}"></div>\n'.format(
-                                folder_path_absolute, picture, picture)
-
-            html_navbar = ''
-            for i, (category, link) in enumerate(self.html_file_path_dict.items()):
-                html_navbar += '<h2><a href="{}">{}</a></h2>\n'.format(link, category.replace("-", " "))
-                if category == category_name:
-                    html_navbar += html_navbar_main
-
-            html = html_A + html_navbar + html_B + html_main + html_C
-            with codecs.open(os.path.join(self.html_path, self.html_file_path_dict[category_name]), 'w',
-                             "utf-8") as html_file:
-                html_file.write(html)
-
+        html_search = '''<div style="padding: 25px 25px 0px 25px">
+    <input type="search" placeholder="Search in the PDFs" oninput="searchLibrary(this.value)" style="width: 100%">
+    <div id="search-results"></div>
+</div>
+<script src="search_index.js"></script>
+<script>
+    function searchLibrary(query) {
+        // sums the weights of the terms starting with each word of the query
+        var scores = {};
+        (query.toLowerCase().match(/[\\p{L}\\p{N}]{2,}/gu) || []).forEach(function (word) {
+            for (var term in SEARCH_INDEX.terms) {
+                if (!term.startsWith(word)) continue;
+                var postings = SEARCH_INDEX.terms[term];
+                for (var i = 0; i < postings.length; i += 2) {
+                    scores[postings[i]] = (scores[postings[i]] || 0) + postings[i + 1];
+                }
+            }
+        });
+        var results = document.getElementById("search-results");
+        results.innerHTML = "";
+        Object.keys(scores).sort(function (a, b) { return scores[b] - scores[a]; }).slice(0, 20).forEach(function (i) {
+            var item = SEARCH_INDEX.documents[i];
+            var link = document.createElement("a");
+            link.href = item[3];
+            link.title = item[2];
+            link.textContent = item[0];
+            link.style.padding = "0px";
+            results.appendChild(link);
+        });
+    }
+</script>
+'''
+        html_live_reload = '''
+<script>
+    new EventSource("events").addEventListener("update", function (event) {
+        if (event.data === "*" || event.data === CATEGORY) location.reload();
+    });
+</script>'''.replace("CATEGORY", json.dumps(category_name))
+
+        page_size, page_by = self.gallery_options["page_size"], self.gallery_options["page_by"]
+        folder_path_absolute = os.path.join(self.root_folder_path_absolute, self.pdf_path, category_name).replace(
+            '\\', '/')
+
+        def pdf_url(file_name):
+            if file_url is None:
+                return '{}/{}'.format(folder_path_absolute, file_name)
+            return file_url(category_name, file_name)
+
+        def picture_url(file_name):
+            if file_url is None:
+                return "file:///{}/{}".format(folder_path_absolute, file_name)
+            return file_url(category_name, file_name)
+
+        df = self.gallery_df[self.gallery_df["Category"] == category_name]
+        thumbnails = self.gallery_thumbnails
+        theme_i = list(df.columns).index("Theme")
+        title_i = list(df.columns).index("Title")
+        file_i = list(df.columns).index("f")
+        pictures_i = list(df.columns).index("Pf")
+        isna = df.isna()
+        placeholder = "https://upload.wikimedia.org/wikipedia/commons/thumb/8/87/PDF_file_icon.svg/195px-PDF_file_icon.svg.png"
+
+        def img_tag(src, alt, thumbnail=None):
+            if thumbnail:
+                return '<img src="{}" alt="{}" width="{}" height="{}" loading="lazy">'.format(
+                    thumbnail[0], alt, thumbnail[1], thumbnail[2])
+            return '<img src="{}" alt="{}" loading="lazy">'.format(src, alt)
+
+        # Themes as [theme, HTML pieces, number of entries, number of images]
+        themes = []
+        for row_i, (index, row) in enumerate(df.iterrows()):
+            if (row_i == 0) or (df.iloc[row_i, theme_i] != df.iloc[row_i - 1, theme_i]):
+                themes.append([df.iloc[row_i, theme_i], [], 0, 0])
+            pieces = themes[-1][1]
+            if isna.iloc[row_i, file_i]:
+                file = None
+                pieces.append('<div class="title-box"><h4>{}</h4></div>'.format(index))
+            else:
+                text = '{} {}'.format(index, df.iloc[row_i, title_i])
+                file = pdf_url(df.iloc[row_i, file_i])
+                pieces.append('<div class="title-box"><h4><a href = "{}">{}</a></h4></div>\n'.format(file, text))
+            pictures_list = df.iloc[row_i, pictures_i]
+            if not pictures_list:
+                if file:
+                    preview = thumbnails.get((category_name, df.iloc[row_i, file_i]))
+                    pieces.append('<div class="image"><a href="{}">{}</a></div>\n'.format(
+                        file, img_tag(placeholder, "preview" if preview else "placeholder", preview)))
+            else:
+                for picture in pictures_list:
+                    thumbnail = thumbnails.get((category_name, picture))
+                    src = picture_url(picture)
+                    if thumbnail:
+                        pieces.append('<div class="image"><a href="{}">{}</a></div>\n'.format(
+                            src, img_tag(src, picture, thumbnail)))
+                    elif file:
+                        pieces.append('<div class="image"><a href="{}">{}</a></div>\n'.format(
+                            file, img_tag(src, picture)))
+                    else:
+                        pieces.append('<div class="image">{}</div>\n'.format(img_tag(src, picture)))
+            themes[-1][2] += 1
+            themes[-1][3] += len(pictures_list) or 1
+
+        # Split into pages on theme boundaries
+        pages = [[]]
+        page_count = 0
+        for theme_pieces in themes:
+            count = theme_pieces[2] if page_by == "entries" else theme_pieces[3]
+            if page_size and pages[-1] and page_count + count > page_size:
+                pages.append([])
+                page_count = 0
+            pages[-1].append(theme_pieces)
+            page_count += count
+        page_file_names = [self.html_file_path_dict[category_name]] + [
+            "{}_page{}.html".format(category_name, page_i + 1) for page_i in range(1, len(pages))]
+
+        html_navbar_main = []
+        for page_file_name, page in zip(page_file_names, pages):
+            for theme_pieces in page:
+                html_navbar_main.append('<h3><a style="padding-left: 60px" href="{}#{}">{}</a></h3>\n'.format(
+                    page_file_name, theme_pieces[0], theme_pieces[0].replace("-", " ")))
+        html_navbar = [html_search] if self.gallery_options["search"] else []
+        for i, (category, link) in enumerate(self.html_file_path_dict.items()):
+            html_navbar.append('<h2><a href="{}">{}</a></h2>\n'.format(link, category.replace("-", " ")))
+            if category == category_name:
+                html_navbar.extend(html_navbar_main)
+        html_navbar = "".join(html_navbar)
+
+        rendered = []
+        for page_i, (page_file_name, page) in enumerate(zip(page_file_names, pages)):
+            if theme is not None:
+                page = [theme_pieces for theme_pieces in page if theme_pieces[0] == theme]
+                if not page: continue
+            html = [html_A, html_navbar, html_B]
+            if len(pages) > 1 and theme is None:
+                html.append('<p class="pages">{}</p>\n'.format(" ".join(
+                    str(i + 1) if i == page_i else '<a href="{}">{}</a>'.format(name, i + 1)
+                    for i, name in enumerate(page_file_names))))
+            for theme_name, pieces, _, _ in page:
+                html.append('<h1 id="{}">{}</h1>\n'.format(theme_name, theme_name.replace("-", " ")))
+                html.extend(pieces)
+            if live_reload:
+                html.append(html_live_reload)
+            html.append(html_C)
+            rendered.append((page_file_name, html))
+        return rendered
+
+    @traced
+    def generate_html_files(self, thumbnail_height=400, thumbnail_threads=8, page_size=None, page_by="entries",
+                            categories=None, search=False):
         print("[GENERATE HTML FILES]")
+        if page_by not in ["entries", "images"]:
+            raise NameError("page_by should be 'entries' or 'images', got " + str(page_by))
         if not os.path.exists(self.html_path): os.makedirs(self.html_path)
 
-        df = pd.read_csv(os.path.join(self.io_path, 'BibCheckResultAll.csv'), index_col=0)
-        self.html_file_path_dict = {category_name: category_name + '.html' for category_name in self.inspect_categories}
-        for category_name in self.inspect_categories:
-            generate_html(df, category_name)
+        self.gallery_options = {"thumbnail_height": thumbnail_height, "thumbnail_threads": thumbnail_threads,
+                                "page_size": page_size, "page_by": page_by, "search": search}
+        categories = self.update_gallery(categories)
+        trace_phase("render")
+        for category_name in categories:
+            pages = self.render_gallery_pages(category_name)
+            page_file_names = [page_file_name for page_file_name, _ in pages]
+            for file_name in os.listdir(self.html_path):
+                if file_name.startswith(category_name + "_page") and file_name not in page_file_names:
+                    os.remove(os.path.join(self.html_path, file_name))
+            for page_file_name, pieces in pages:
+                # pages whose content did not change since they were last written are skipped
+                page_hash = hashlib.sha1()
+                for piece in pieces:
+                    page_hash.update(piece.encode("utf-8"))
+                page_hash = page_hash.digest()
+                page_file_path = os.path.join(self.html_path, page_file_name)
+                if self.gallery_page_hashes.get(page_file_name) == page_hash and os.path.exists(page_file_path):
+                    trace_count("pages skipped")
+                    continue
+                self.gallery_page_hashes[page_file_name] = page_hash
+                with codecs.open(page_file_path, 'w', "utf-8") as html_file:
+                    for piece in pieces:
+                        html_file.write(piece)
+                trace_count("pages written")
+                trace_written(page_file_path)
         print("+ HTML files saved in", self.html_path)
         print()
-
-    def gallery_watch(self):
+        if search:
+            trace_phase("search index")
+            self.update_text_index(self.gallery_df)
+            self.write_search_index()
+
+    @traced
+    def gallery_update(self, file_paths, write_files=True):
+        # Update the gallery for pictures and PDFs that were added, changed or removed, without a full check.
+        # Only the entries of the files are updated in the in-memory index and each category is rendered once,
+        # writing only the pages that changed. Without write_files, only the index and the thumbnails are updated, for
+        # Bib.serve. Returns the set of categories updated
+
+        def render(categories):
+            if write_files:
+                self.generate_html_files(categories=categories, **self.gallery_options)
+            else:
+                self.update_gallery(categories)
+
+        if self.gallery_df is None:
+            render(None)
+            return set(self.inspect_categories)
+        import pandas as pd
+        categories = set()
+        for file_path in file_paths:
+            category_path, file_name = os.path.split(os.path.abspath(file_path))
+            category_name = os.path.basename(category_path)
+            if os.path.dirname(category_path) != os.path.abspath(self.pdf_path): continue
+            if category_name not in self.inspect_categories: continue
+            if " " not in file_name or "." not in file_name: continue
+            name, file_type = file_name.rsplit(".", 1)
+            short_code, title = name.split(" ", 1)
+            if file_type.lower() not in ["pdf", "jpg", "png"]: continue
+            categories.add(category_name)
+
+            df = self.gallery_df
+            if short_code in df.index and df.at[short_code, "Category"] != category_name:
+                # a short code collision, which the full check reports
+                self.check(show_incomplete=False)
+                self.gallery_df = None
+                render(None)
+                return set(self.inspect_categories)
+            if not os.path.isfile(file_path):
+                # removed, or moved away
+                if short_code not in df.index: continue
+                self.gallery_thumbnails.pop((category_name, file_name), None)
+                if file_type.lower() == "pdf":
+                    if df.at[short_code, "f"] == file_name:
+                        df.at[short_code, "f"] = None
+                        df.at[short_code, "Link"] = ""
+                elif file_name in df.at[short_code, "Pf"]:
+                    df.at[short_code, "Pf"].remove(file_name)
+                    df.at[short_code, "P"] -= 1
+                if pd.isna(df.at[short_code, "f"]) and not df.at[short_code, "Pf"] and df.at[short_code, "B"] == 0:
+                    self.gallery_df = df.drop(index=short_code)
+                continue
+            if short_code not in df.index:
+                entry_store = EntryStore()
+                entry_store.add(category_name, short_code).title = title_shorter(title)
+                df = pd.concat([df, entry_store.to_dataframe()])
+                df = df.sort_values(by=['Category', 'Theme'], ascending=[True, True], kind="stable")
+                self.gallery_df = df
+            if file_type.lower() == "pdf":
+                df.at[short_code, "f"] = file_name
+                df.at[short_code, "Link"] = "[](<" + os.path.join(category_path, file_name) + ">)"
+            elif file_name not in df.at[short_code, "Pf"]:
+                df.at[short_code, "Pf"].append(file_name)
+                df.at[short_code, "P"] += 1
+        if categories:
+            render(sorted(categories))
+        return categories
+
+    def start_gallery_watch(self, quiet_period=1.0, write_files=True, on_update=None, lock=None):
+        # Watch the PDF folders and the .bib files in the background and update the gallery after each burst of
+        # changes, writing the pages unless write_files is False. on_update(categories) is called after each update,
+        # with None after a full rebuild, and the updates hold lock, if given. Returns a function that stops watching
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+        lock = lock or contextlib.nullcontext()
 
         class MyHandler(FileSystemEventHandler):
-            def __init__(self, bib):
+            def __init__(self, bib, work_queue):
                 self.bib = bib
+                self.work_queue = work_queue
+                self.bibtex_path = os.path.abspath(bib.bibtex_path)
+                self.pdf_path = os.path.abspath(bib.pdf_path)
+
+            def on_any_event(self, event):
+                if event.is_directory or event.event_type not in ["created", "moved", "deleted", "modified"]:
+                    return
+                self.bib.gallery_watch_counters["events"] += 1
+                paths = [event.src_path] + ([event.dest_path] if event.event_type == "moved" else [])
+                for path in paths:
+                    path = os.path.abspath(path)
+                    if path.endswith(".bib") and os.path.dirname(path) == self.bibtex_path:
+                        self.work_queue.put("bib", path)
+                    elif path.lower().endswith((".png", ".jpg", ".pdf")) and \
+                            os.path.dirname(os.path.dirname(path)) == self.pdf_path:
+                        self.work_queue.put(os.path.basename(os.path.dirname(path)), path)
+
+        def rebuild_worker(work_queue):
+            bib_hashes = {}
+            while True:
+                batch = work_queue.get()
+                if batch is None: return
+                try:
+                    bib_changed = False
+                    for path in set(batch.get("bib", [])):
+                        # the check rewrites the BibTeX files it normalizes, which should not start another check
+                        bib_hash = file_fingerprint(path)["hash"] if os.path.isfile(path) else None
+                        bib_changed = bib_changed or bib_hashes.get(path) != bib_hash
+                    if bib_changed:
+                        # only a change of the BibTeX needs the full check
+                        print("Files", ", ".join(sorted(set(batch["bib"]))), "have been modified")
+                        with lock:
+                            self.check(show_incomplete=False)
+                            self.gallery_df = None
+                            if write_files:
+                                self.generate_html_files(**self.gallery_options)
+                            else:
+                                self.update_gallery()
+                        self.gallery_watch_counters["full rebuilds"] += 1
+                        # the files the check rewrote are stated again by the scan
+                        snapshot = self.scan()
+                        for file_name in snapshot.bib_files:
+                            if file_name.endswith(".bib"):
+                                path = os.path.abspath(os.path.join(self.bibtex_path, file_name))
+                                bib_hashes[path] = snapshot.bibtex_file_fingerprint(file_name[:-4])["hash"]
+                        if on_update: on_update(None)
+                    else:
+                        batch.pop("bib", None)
+                        if not batch: continue
+                        file_paths = [path for paths in batch.values() for path in dict.fromkeys(paths)]
+                        with lock:
+                            categories = self.gallery_update(file_paths, write_files)
+                        for category_name in sorted(categories):
+                            print("+ Gallery of", category_name, "updated for", len(batch.get(category_name, [])),
+                                  "events")
+                            self.gallery_watch_counters["category rebuilds"] += 1
+                        if on_update and categories: on_update(categories)
+                except Exception as e:
+                    print("- Gallery update failed:", repr(e))
+                print()
+                print("[GALLERY WATCH]")
 
-            def on_created(self, event):
-                if event.src_path.endswith("png") or event.src_path.endswith("jpg"):
-                    print(f'File {event.src_path} has been modified')
-                    self.bib.check(show_incomplete=False)
-                    self.bib.generate_html_files()
-                    print()
-                    print("[GALLERY WATCH]")
-
-        print("[GALLERY WATCH]")
         folder_to_watch = os.path.join(self.root_folder_path, self.pdf_path)
 
-        event_handler = MyHandler(self)
+        self.gallery_watch_counters = {"events": 0, "category rebuilds": 0, "full rebuilds": 0}
+        work_queue = DebouncedQueue(quiet_period)
+        worker = threading.Thread(target=rebuild_worker, args=(work_queue,), daemon=True)
+        worker.start()
+        event_handler = MyHandler(self, work_queue)
         observer = Observer()
         observer.schedule(event_handler, folder_to_watch, recursive=True)
+        observer.schedule(event_handler, self.bibtex_path, recursive=False)
         observer.start()
 
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
+        def stop():
             observer.stop()
-        observer.join()
-
-    def collect(self):
+            observer.join()
+            work_queue.close()
+            worker.join()
 
-        def make_valid_filename(filename):
-            valid_filename = re.sub(r'[\\/:"*?<>|]', '', filename)
-            valid_filename = valid_filename.strip()
-            return valid_filename
+        return stop
 
-        def get_short_codes_from_bib_str(bib_str):
-            short_codes_set = set()
-            entries = main_parser(bib_str).split('\n\n\n')
-            for i in range(len(entries)):
-                short_codes_set.add(entries[i].split("{", 1)[1].split(",", 1)[0])
-            return short_codes_set
+    @traced
+    def gallery_watch(self, quiet_period=1.0):
+        print("[GALLERY WATCH]")
+        stop = self.start_gallery_watch(quiet_period)
 
-        def move_file(source_path, destination_path):
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        stop()
+        for name, value in self.gallery_watch_counters.items():
+            trace_count(name, value)
+        print("+ Events received:", self.gallery_watch_counters["events"],
+              " category rebuilds:", self.gallery_watch_counters["category rebuilds"],
+              " full rebuilds:", self.gallery_watch_counters["full rebuilds"])
+
+    @traced
+    def serve(self, host="127.0.0.1", port=8000, thumbnail_height=400, thumbnail_threads=8, page_size=None,
+              page_by="entries", search=False, watch=True, quiet_period=1.0):
+        # Serve the gallery over HTTP, rendering the pages from the in-memory index instead of writing them, and
+        # updating open pages when the library changes
+        print("[SERVE]")
+        if page_by not in ["entries", "images"]:
+            raise NameError("page_by should be 'entries' or 'images', got " + str(page_by))
+        self.gallery_options = {"thumbnail_height": thumbnail_height, "thumbnail_threads": thumbnail_threads,
+                                "page_size": page_size, "page_by": page_by, "search": search}
+        self.gallery_df = None
+        self.update_gallery()
+        if search:
+            self.update_text_index(self.gallery_df)
+        server = GalleryServer(self)
+        try:
+            asyncio.run(server.run(host, port, quiet_period if watch else None))
+        except KeyboardInterrupt:
+            pass
+        for name, value in server.counters.items():
+            trace_count(name, value)
+        print("+ Requests:", server.counters["requests"], " pages rendered:", server.counters["pages rendered"],
+              " not modified:", server.counters["not modified"], " events sent:", server.counters["events sent"])
+
+    def resolve_pdfs(self, pdf_file_paths, resolver=None, threads=8):
+        # BibTeX string of each PDF, or None if it could not be resolved. Results are cached in resolver_cache.json by
+        # the content hash of the PDF, and the PDFs not in the cache are resolved concurrently on a thread pool
+        resolver = resolver or resolve_with_pdf2bib
+        cache_file_path = os.path.join(self.cache_path, "resolver_cache.json")
+        cache = load_json(cache_file_path, {})
+
+        def resolve(pdf_file_path):
             try:
-                shutil.move(source_path, destination_path)
-            except FileNotFoundError:
-                raise NameError(f"File '{source_path}' not found.")
+                return True, resolver(pdf_file_path)
             except Exception as e:
-                raise NameError(f"Error: {str(e)}")
-
-        def bib_single_new_short_code(bib, short_code):
-            left = bib.split("{")[0]
-            right = bib.split(",", 1)[1]
-            return left + "{" + short_code + "," + right
-
-        print("[COLLECT]")
-        count_collected = 0
+                print("- Failed to resolve '" + pdf_file_path + "':", str(e))
+                return False, None
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pdf_hashes = list(executor.map(lambda pdf_file_path: file_fingerprint(pdf_file_path)["hash"],
+                                           pdf_file_paths))
+            # identical PDFs are resolved once
+            missing = {pdf_hash: pdf_file_path for pdf_hash, pdf_file_path in zip(pdf_hashes, pdf_file_paths)
+                       if pdf_hash not in cache}
+            results = dict(zip(missing.keys(), map_counted(executor, resolve, missing.values())))
+        trace_count("cache hits", len(pdf_hashes) - len(missing))
+        trace_count("PDFs resolved", len(missing))
+        for pdf_hash, (resolved, bib_string) in results.items():
+            # failures are not cached, so they are tried again next time
+            if resolved: cache[pdf_hash] = bib_string
+        if missing:
+            if not os.path.exists(self.cache_path): os.makedirs(self.cache_path)
+            save_json(cache_file_path, cache)
+        return [cache.get(pdf_hash) for pdf_hash in pdf_hashes]
+
+    def list_pdfs_to_collect(self):
+        pdf_files = []
         for category in os.listdir(self.pdf_collect_path):
             if category not in self.inspect_categories: continue
-            # print("- Collecting category: ", category)
             category_folder_path = os.path.join(self.pdf_collect_path, category)
-
-            with codecs.open(os.path.join(self.bibtex_path, category + ".bib"), 'r', "utf-8") as file:
-                bibtex_data = file.read()
-            short_codes = get_short_codes_from_bib_str(bibtex_data)
             for pdf_file in os.listdir(category_folder_path):
-                pdf_file_path = os.path.join(category_folder_path, pdf_file)
-
                 if pdf_file[-4:] != ".pdf": continue
-                theme = pdf_file[:-4].strip().replace(" ", "-")
-                result = pdf2bib.pdf2bib(pdf_file_path)
-                bib_string = result['bibtex']
-
-                bibtex_single_item = analyze_bibtex_single_item(bib_string)
-                short_code = bibtex_single_item["author"][0].last[0] + "-" + bibtex_single_item["year"] + "-" + theme
-
-                bib_string = bib_single_new_short_code(bib_string, short_code)
-
-                if short_code in short_codes:
-                    raise NameError("Short code collision " + short_code)
-                new_file_name = make_valid_filename(short_code + " " + bibtex_single_item["title"] + ".pdf")
-
-                print(bib_string)
-                print("? Collect '" + os.path.join(category_folder_path, pdf_file) + "' as '" + new_file_name + "'")
-                decision = input("  and collect the above bibtex string ([y]/n)?")
-                if decision.strip() in ["", "y", "Y"]:
-                    move_file(pdf_file_path,
-                              os.path.join(os.path.join(self.pdf_path, category), new_file_name))
-                    write_to_end_of_file(os.path.join(self.bibtex_path, category + ".bib"), "\n\n" + bib_string + "\n")
-                    print("+ Renamed '" + pdf_file + "' as '" + new_file_name + "'")
-                    print("+ Moved the PDF from '" + category_folder_path + "' to '" + \
-                          os.path.join(self.root_folder_path, category) + "'")
-                    print("+ Added Bibtex to '" + os.path.join(self.bibtex_path, category + ".bib'"))
-                    count_collected += 1
+                pdf_files.append((category, pdf_file))
+        return pdf_files
+
+    @traced
+    def collect(self, enforce=False, resolver=None, threads=8):
+        print("[COLLECT]")
+        count_collected = 0
+        pdf_files = self.list_pdfs_to_collect()
+        bib_strings = self.resolve_pdfs([os.path.join(self.pdf_collect_path, category, pdf_file)
+                                         for category, pdf_file in pdf_files], resolver, threads)
+        registry = self.update_short_code_registry()
+        for (category, pdf_file), bib_string in zip(pdf_files, bib_strings):
+            category_folder_path = os.path.join(self.pdf_collect_path, category)
+            pdf_file_path = os.path.join(category_folder_path, pdf_file)
+            if bib_string is None:
+                print("- No metadata found for '" + pdf_file_path + "'")
+                continue
+            short_code, bib_string, new_file_name = propose_collect_item(
+                bib_string, pdf_file, registry.available if enforce else None)
+            if short_code in registry:
+                raise NameError("Short code collision " + short_code + " with the entry in " +
+                                ", ".join(sorted(registry.categories(short_code))))
+
+            print(bib_string)
+            print("? Collect '" + os.path.join(category_folder_path, pdf_file) + "' as '" + new_file_name + "'")
+            decision = input("  and collect the above bibtex string ([y]/n)?")
+            if decision.strip() in ["", "y", "Y"]:
+                move_file(pdf_file_path,
+                          os.path.join(os.path.join(self.pdf_path, category), new_file_name))
+                write_to_end_of_file(os.path.join(self.bibtex_path, category + ".bib"), "\n\n" + bib_string + "\n")
+                registry.add(("bib", category), short_code)
+                registry.add(("folder", category), short_code, new_file_name)
+                print("+ Renamed '" + pdf_file + "' as '" + new_file_name + "'")
+                print("+ Moved the PDF from '" + category_folder_path + "' to '" + \
+                      os.path.join(self.root_folder_path, category) + "'")
+                print("+ Added Bibtex to '" + os.path.join(self.bibtex_path, category + ".bib'"))
+                count_collected += 1
+            else:
+                print("  Nothing changed for this item.")
+        registry.save()
+        if count_collected == 0:
+            print("+ Nothing collected")
+        else:
+            print("+ Collected", count_collected, "sources")
+        print()
+
+    @traced
+    def collect_batch(self, review="collect_review.json", resolver=None, threads=8, enforce=False):
+        # Resolve all PDFs to collect without asking, and write the proposals to a review file for Bib.collect_apply
+        print("[COLLECT BATCH]")
+        pdf_files = self.list_pdfs_to_collect()
+        bib_strings = self.resolve_pdfs([os.path.join(self.pdf_collect_path, category, pdf_file)
+                                         for category, pdf_file in pdf_files], resolver, threads)
+        registry = self.update_short_code_registry()
+        proposed_short_codes = set()
+
+        def available(short_code):
+            return registry.available(short_code, proposed_short_codes)
+
+        items = []
+        for (category, pdf_file), bib_string in zip(pdf_files, bib_strings):
+            item = {"approve": False, "category": category, "pdf": pdf_file, "short_code": None, "file_name": None,
+                    "bibtex": bib_string, "issue": None}
+            if bib_string is None:
+                item["issue"] = "No metadata found"
+            else:
+                try:
+                    item["short_code"], item["bibtex"], item["file_name"] = propose_collect_item(
+                        bib_string, pdf_file, available if enforce else None)
+                except (KeyError, IndexError, AttributeError):
+                    item["issue"] = "Incomplete metadata"
                 else:
-                    print("  Nothing changed for this item.")
+                    if item["short_code"] in registry or item["short_code"] in proposed_short_codes:
+                        item["issue"] = "Short code collision"
+                    else:
+                        item["approve"] = True
+                        proposed_short_codes.add(item["short_code"])
+            if item["issue"]:
+                print("- " + item["issue"] + ": '" + os.path.join(category, pdf_file) + "'")
+            items.append(item)
+        save_json(os.path.join(self.io_path, review), items)
+        print("+ Proposed", sum(item["approve"] for item in items), "of", len(items), "sources in '" +
+              os.path.join(self.io_path, review) + "'")
+        print()
+
+    @traced
+    def collect_apply(self, review="collect_review.json"):
+        # Collect the approved items of the review file of Bib.collect_batch, with one append per category .bib
+        print("[COLLECT APPLY]")
+        review_file_path = os.path.join(self.io_path, review)
+        items = load_json(review_file_path, None)
+        if items is None:
+            raise NameError("No review file " + review_file_path + ", run Bib.collect_batch first")
+        approved = [item for item in items if item["approve"]]
+        registry = self.update_short_code_registry()
+        appended = {}
+        collected = set()  # ids of the items whose PDF was moved
+        try:
+            for item in approved:
+                category = item["category"]
+                pdf_file_path = os.path.join(self.pdf_collect_path, category, item["pdf"])
+                if not os.path.exists(pdf_file_path):
+                    print("- File not found '" + pdf_file_path + "'")
+                    continue
+                # the short code edited in the review file wins: it becomes the BibTeX key and starts the file name
+                short_code = (item["short_code"] or "").strip()
+                if not short_code or analyse_short_code(short_code)[2] is None or not item["bibtex"]:
+                    print("- No valid short code or BibTeX for '" + pdf_file_path + "'")
+                    continue
+                if short_code in registry:
+                    print("- Short code collision " + short_code + " for '" + pdf_file_path + "'")
+                    continue
+                file_name = make_valid_filename(short_code + " " + (item["file_name"] or item["pdf"]).split(" ", 1)[-1])
+                destination_path = os.path.join(self.pdf_path, category, file_name)
+                if not os.path.isdir(os.path.dirname(destination_path)):
+                    print("- No folder '" + os.path.dirname(destination_path) + "' for '" + pdf_file_path + "'")
+                    continue
+                if os.path.exists(destination_path):
+                    print("- File '" + destination_path + "' already exists")
+                    continue
+                move_file(pdf_file_path, destination_path)
+                collected.add(id(item))
+                appended.setdefault(category, []).append(bib_single_new_short_code(item["bibtex"], short_code))
+                registry.add(("bib", category), short_code)
+                registry.add(("folder", category), short_code, file_name)
+                print("+ Collected '" + item["pdf"] + "' as '" + file_name + "'")
+        finally:
+            # even if a move fails, the BibTeX of the PDFs already moved is written and their items leave the review
+            # file, so a rerun only retries the others
+            for category, bib_strings in appended.items():
+                write_to_end_of_file(os.path.join(self.bibtex_path, category + ".bib"),
+                                     "".join("\n\n" + bib_string + "\n" for bib_string in bib_strings))
+                print("+ Added", len(bib_strings), "Bibtex to '" + os.path.join(self.bibtex_path, category + ".bib'"))
+            save_json(review_file_path, [item for item in items if id(item) not in collected])
+            registry.save()
+        count_collected = sum(len(bib_strings) for bib_strings in appended.values())
         if count_collected == 0:
             print("+ Nothing collected")
         else:
             print("+ Collected", count_collected, "sources")
         print()
 
+    @traced
     def theme_replace(self, old, new):
         print("[THEME REPLACE]")
-        categories = self.inspect_categories
+        # the registry gives the short codes of the theme and the categories holding them, and the new short codes are
+        # checked against all others before anything is renamed
+        snapshot = self.scan()
+        registry = self.update_short_code_registry(snapshot)
+        renames = {}
+        for short_code in registry.index:
+            author, year, theme, suffix = analyse_short_code(short_code)
+            if theme == old and registry.categories(short_code).intersection(self.inspect_categories):
+                renames[short_code] = author + "-" + year + "-" + new + suffix
+        for short_code, short_code_new in sorted(renames.items()):
+            if short_code_new in registry and short_code_new not in renames:
+                raise NameError("Short code collision " + short_code_new + " renaming " + short_code)
+        categories = [category for category in self.inspect_categories
+                      if any(category in registry.categories(short_code) for short_code in renames)]
         # print("- Theme replacing  old:", old, " new:", new, " categories:", categories)
 
+        def rename(short_code):
+            author, year, theme, suffix = analyse_short_code(short_code)
+            if theme == old:
+                short_code_new = author + "-" + year + "-" + new + suffix
+                print("+ Bibtex short code updated from", short_code, "to",
+                      short_code_new)
+                trace_count("entries renamed")
+                return short_code_new
+
         # modify bibtex file
-        for category in os.listdir(self.bibtex_path):
+        for category in snapshot.bib_files:
             bibtex_file_path = os.path.join(self.bibtex_path, category)
-            if os.path.isfile(bibtex_file_path):
-                category = category[:-4]
-                if category not in categories: continue
-                # print("- Updating bibtex of category: ", category_name)
-                with codecs.open(bibtex_file_path, 'r', "utf-8") as file:
-                    bibtex_data = file.read()
-                bibtex_data = main_parser(bibtex_data)
-                # Split the BibTeX entries
-                entries = bibtex_data.split('\n\n\n')
-                for i in range(len(entries)):
-                    left, right = entries[i].split("{", 1)
-                    short_code, right = right.split(",", 1)
-
-                    author, year, theme, suffix = analyse_short_code(short_code)
-                    if theme == old:
-                        short_code_new = author + "-" + year + "-" + new + suffix
-                        print("+ Bibtex short code updated from", short_code, "to",
-                              short_code_new)
-                        entries[i] = left.lower() + "{" + short_code_new + "," + right
-                sorted_entries = sorted(entries, key=lambda x: x.split('{')[1].split(',')[0].strip())
-                new_bibtex = '\n\n\n'.join(sorted_entries)
-                with codecs.open(bibtex_file_path, 'w', "utf-8") as file:
-                    file.write(new_bibtex)
+            category = category[:-4]
+            if category not in categories: continue
+            # print("- Updating bibtex of category: ", category_name)
+            if self.rewrite_bibtex_keys(category, rename) is not None: continue
+            with codecs.open(bibtex_file_path, 'r', "utf-8") as file:
+                bibtex_data = file.read()
+            bibtex_data = self.parse_bibtex(bibtex_data)
+            # Split the BibTeX entries
+            entries = bibtex_data.split('\n\n\n')
+            for i in range(len(entries)):
+                left, right = entries[i].split("{", 1)
+                short_code, right = right.split(",", 1)
+                short_code_new = rename(short_code)
+                if short_code_new is not None:
+                    entries[i] = left.lower() + "{" + short_code_new + "," + right
+            sorted_entries = sorted(entries, key=lambda x: x.split('{')[1].split(',')[0].strip())
+            new_bibtex = '\n\n\n'.join(sorted_entries)
+            with codecs.open(bibtex_file_path, 'w', "utf-8") as file:
+                file.write(new_bibtex)
+            trace_written(bibtex_file_path)
 
         # modify file
-        for category in os.listdir(self.pdf_path):
+        for category in snapshot.folders:
             if category not in categories: continue
             # print("- Updating files of category:", category_name)
             category_path = os.path.join(self.pdf_path, category)
-            for file_name in os.listdir(category_path):
-                if os.path.isfile(os.path.join(category_path, file_name)):
-                    short_code, title = file_name.split(" ", 1)
-                    author, year, theme, suffix = analyse_short_code(short_code)
-                    if theme == old:
-                        # print("- Modifying file:", file_name)
-
-                        short_code_new = author + "-" + year + "-" + new + suffix
-                        file_name_new = short_code_new + " " + title
-                        print("+ File short code from", short_code, "to",
-                              short_code_new, "(" + compress_string(file_name) + ")")
-                        os.rename(os.path.join(category_path, file_name),
-                                  os.path.join(category_path, file_name_new))
+            for file_name in snapshot.file_names(category):
+                short_code, title = file_name.split(" ", 1)
+                author, year, theme, suffix = analyse_short_code(short_code)
+                if theme == old:
+                    # print("- Modifying file:", file_name)
+
+                    short_code_new = author + "-" + year + "-" + new + suffix
+                    file_name_new = short_code_new + " " + title
+                    print("+ File short code from", short_code, "to",
+                          short_code_new, "(" + compress_string(file_name) + ")")
+                    os.rename(os.path.join(category_path, file_name),
+                              os.path.join(category_path, file_name_new))
+                    trace_count("files renamed")
+        for short_code, short_code_new in renames.items():
+            registry.rename(short_code, short_code_new, categories)
+        registry.save()
         print()
 
+    @traced
     def short_code_replace(self, old, new):
-        categories = self.inspect_categories
         print("[SHORT CODE REPLACE]")
         # print("- Short code replacing  old:", old, " new:", new, " categories:", categories)
 
-        # modify bibtex file
-        for category in os.listdir(self.bibtex_path):
-            bibtex_file_path = os.path.join(self.bibtex_path, category)
-            if os.path.isfile(bibtex_file_path):
+        def rename(short_code):
+            if short_code == old:
+                print("+ Bibtex short code updated from", old, "to", new)
+                trace_count("entries renamed")
+                return new
+
+        def replace_in(categories):
+            count = 0
+
+            # modify bibtex file
+            for category in snapshot.bib_files:
+                bibtex_file_path = os.path.join(self.bibtex_path, category)
                 category_name = category[:-4]
                 if category_name not in categories: continue
                 # print("- Updating bibtex of category: ", category_name)
+                count_renamed = self.rewrite_bibtex_keys(category_name, rename)
+                if count_renamed is not None:
+                    count += count_renamed
+                    continue
                 with codecs.open(bibtex_file_path, 'r', 'utf-8') as file:
                     bibtex_data = file.read()
-                bibtex_data = main_parser(bibtex_data)
+                bibtex_data = self.parse_bibtex(bibtex_data)
                 # Split the BibTeX entries
                 entries = bibtex_data.split('\n\n\n')
                 for i in range(len(entries)):
                     left, right = entries[i].split("{", 1)
                     short_code, right = right.split(",", 1)
-                    if short_code == old:
+                    if rename(short_code) is not None:
                         # print("- Modifying bibtex:", short_code)
-                        print("+ Bibtex short code updated from", old, "to", new)
+                        count += 1
                         entries[i] = left.lower() + "{" + new + "," + right
                 sorted_entries = sorted(entries, key=lambda x: x.split('{')[1].split(',')[0].strip())
                 new_bibtex = '\n\n\n'.join(sorted_entries)
                 with codecs.open(bibtex_file_path, 'w', 'utf-8') as file:
                     file.write(new_bibtex)
+                trace_written(bibtex_file_path)
 
-        # modify file
-        for category in os.listdir(self.pdf_path):
-            if category not in categories: continue
-            # print("- Updating files of category:", category_name)
-            category_path = os.path.join(self.pdf_path, category)
-            for file_name in os.listdir(category_path):
-                if os.path.isfile(os.path.join(category_path, file_name)):
+            # modify file
+            for category in snapshot.folders:
+                if category not in categories: continue
+                # print("- Updating files of category:", category_name)
+                category_path = os.path.join(self.pdf_path, category)
+                for file_name in snapshot.file_names(category):
                     short_code, title = file_name.split(" ", 1)
                     if short_code == old:
                         print("+ File short code from", old, "to",
                               new, "(" + compress_string(file_name) + ")")
+                        count += 1
                         file_name_new = new + " " + title
                         os.rename(os.path.join(category_path, file_name),
                                   os.path.join(category_path, file_name_new))
+                        trace_count("files renamed")
+            return count
+
+        # the registry knows the categories of the short code, other categories are only searched if it is outdated.
+        # Both passes use the same listings, as the first one renames nothing when the second one runs
+        snapshot = self.scan()
+        registry = self.update_short_code_registry(snapshot)
+        if new != old and new in registry:
+            raise NameError("Short code collision " + new + " with the entry in " +
+                            ", ".join(sorted(registry.categories(new))))
+        categories = [category for category in self.inspect_categories if category in registry.categories(old)]
+        if replace_in(categories) == 0 and categories != self.inspect_categories:
+            replace_in(self.inspect_categories)
+        registry.rename(old, new, self.inspect_categories)
+        registry.save()
         print()
 
-    def select_from_typst(self, input="input.typ", output="selected.bib"):
-        legal_characters = "abcdefghijklmnopqrstuvwxyz"
-        legal_characters = legal_characters.upper() + legal_characters + "0123456789" + "-"
-
-        def contains_year(input_string):
-            match = re.search(re.compile(r'\b[a-zA-Z-]*\d{4}[a-zA-Z-]*\b'), input_string)
-            if match:
-                return True
+    @traced
+    def batch_rename(self, themes=None, short_codes=None, mapping_file=None):
+        # Apply many theme and short code renames in one pass over the .bib files and PDF folders. All renames refer
+        # to the names before the batch, and a short code rename wins over the rename of its theme. The changes are
+        # journaled before they are applied, so an interrupted batch can be finished by Bib.resume_rename or undone by
+        # Bib.rollback_rename
+        print("[BATCH RENAME]")
+        themes, short_codes = dict(themes or {}), dict(short_codes or {})
+        if mapping_file is not None:
+            with codecs.open(os.path.join(self.io_path, mapping_file), "r", "utf-8") as file:
+                for row in csv.DictReader(file):
+                    kind = row["kind"].strip().lower().replace("_", " ")
+                    if kind == "theme":
+                        themes[row["old"].strip()] = row["new"].strip()
+                    elif kind == "short code":
+                        short_codes[row["old"].strip()] = row["new"].strip()
+                    else:
+                        raise NameError("Unknown kind of rename " + row["kind"] + ", use 'theme' or 'short code'")
+        journal_path = os.path.join(self.cache_path, "rename_journal")
+        if os.path.exists(os.path.join(journal_path, "journal.json")):
+            raise NameError("An interrupted batch rename is journaled in " + journal_path +
+                            ", finish it with Bib.resume_rename or undo it with Bib.rollback_rename first")
+
+        shutil.rmtree(journal_path, ignore_errors=True)  # left by a batch that stopped before its journal was committed
+        final_short_codes = {}
+
+        def rename(short_code):
+            # the new short code, checking that it collides with no other
+            if short_code in short_codes:
+                new_short_code = short_codes[short_code]
             else:
-                return False
-
-        def get_front_shortcode(input_string):
-            i = 0
-            while i < len(input_string) and input_string[i] in legal_characters: i += 1
-            if contains_year(input_string[:i]):
-                return input_string[:i]
+                author, year, theme, suffix = analyse_short_code(short_code)
+                new_short_code = short_code if theme not in themes else author + "-" + year + "-" + themes[theme] + suffix
+            previous = final_short_codes.setdefault(new_short_code, short_code)
+            if previous != short_code:
+                raise NameError("Short code collision " + new_short_code + " renaming " + previous + " and " + short_code)
+            return new_short_code
+
+        def rename_changed(short_code):
+            short_code_new = rename(short_code)
+            return short_code_new if short_code_new != short_code else None
+
+        # 1. Check the whole mapping against every short code of the registry before anything is written: the short
+        # codes of the additional categories are kept, those of the categories are renamed
+        snapshot = self.scan()
+        registry = self.update_short_code_registry(snapshot)
+        renamed_short_codes = []
+        for short_code in sorted(registry.index):
+            if registry.categories(short_code).intersection(self.inspect_categories):
+                renamed_short_codes.append(short_code)
+            if not registry.categories(short_code).issubset(self.inspect_categories):
+                final_short_codes[short_code] = short_code
+        for short_code in renamed_short_codes:
+            rename(short_code)
+
+        # 2. Plan the new BibTeX files, written to the journal folder, and the file names
+        os.makedirs(journal_path, exist_ok=True)
+        bibtex_categories, file_renames, messages = [], [], []
+        for category_file in snapshot.bib_files:
+            bibtex_file_path = os.path.join(self.bibtex_path, category_file)
+            category_name = category_file[:-4]
+            if category_name not in self.inspect_categories: continue
+            new_bibtex_file_path = os.path.join(journal_path, category_name + ".new.bib")
+            count = self.rewrite_bibtex_keys(category_name, rename_changed, new_bibtex_file_path)
+            if count is None:
+                with codecs.open(bibtex_file_path, 'r', "utf-8") as file:
+                    bibtex_data = file.read()
+                entries = self.parse_bibtex(bibtex_data).split('\n\n\n')
+                count = 0
+                for i in range(len(entries)):
+                    left, right = entries[i].split("{", 1)
+                    short_code, right = right.split(",", 1)
+                    short_code_new = rename_changed(short_code)
+                    if short_code_new is not None:
+                        entries[i] = left.lower() + "{" + short_code_new + "," + right
+                        count += 1
+                if count:
+                    sorted_entries = sorted(entries, key=lambda x: x.split('{')[1].split(',')[0].strip())
+                    save_atomically(new_bibtex_file_path, '\n\n\n'.join(sorted_entries).encode("utf-8"))
+            if count:
+                shutil.copyfile(bibtex_file_path, os.path.join(journal_path, category_name + ".old.bib"))
+                bibtex_categories.append(category_name)
+                messages.append("+ Bibtex short codes updated: {} in {}".format(count, category_name))
+            elif os.path.exists(new_bibtex_file_path):
+                os.remove(new_bibtex_file_path)
+        for category in snapshot.folders:
+            if category not in self.inspect_categories: continue
+            category_path = os.path.join(self.pdf_path, category)
+            count = 0
+            for file_name in snapshot.file_names(category):
+                if " " not in file_name: continue
+                short_code, title = file_name.split(" ", 1)
+                short_code_new = rename(short_code)
+                if short_code_new != short_code:
+                    file_renames.append((os.path.join(category_path, file_name),
+                                         os.path.join(category_path, short_code_new + " " + title)))
+                    count += 1
+            if count:
+                messages.append("+ File short codes updated: {} in {}".format(count, category))
+        for message in messages:
+            print(message)
+
+        # 3. Commit the journal of the old and new BibTeX files and the file renames, then apply it
+        save_json(os.path.join(journal_path, "journal.json"), {"categories": bibtex_categories, "files": file_renames})
+        self.apply_rename_journal(forward=True)
+        print("+ Batch applied:", len(bibtex_categories), "BibTeX files and", len(file_renames), "files renamed")
+        print()
 
-        def collect_short_code_from_typst(input_data):
-            short_code_entries = [get_front_shortcode(x) for x in input_data.split("@")[1:]] + \
-                                 [x[1:-1] for x in re.findall(r'<[A-Za-z0-9\-]+-\d{4}-[A-Za-z0-9\-]+>', input_data)]
+    def apply_rename_journal(self, forward=True):
+        # Bring the .bib files and file names to the new (or old) state of the journal, whatever was applied before
+        journal_path = os.path.join(self.cache_path, "rename_journal")
+        journal = load_json(os.path.join(journal_path, "journal.json"), None)
+        if journal is None:
+            raise NameError("No interrupted batch rename journaled in " + journal_path)
+        for category_name in journal["categories"]:
+            bibtex_file_path = os.path.join(self.bibtex_path, category_name + ".bib")
+            shutil.copyfile(os.path.join(journal_path, category_name + (".new.bib" if forward else ".old.bib")),
+                            bibtex_file_path + ".tmp")
+            os.replace(bibtex_file_path + ".tmp", bibtex_file_path)
+        count = 0
+        for old_file_path, new_file_path in journal["files"]:
+            source, destination = (old_file_path, new_file_path) if forward else (new_file_path, old_file_path)
+            if os.path.exists(source) and not os.path.exists(destination):
+                os.rename(source, destination)
+                trace_count("files renamed")
+                count += 1
+        shutil.rmtree(journal_path)
+        return count
+
+    @traced
+    def resume_rename(self):
+        print("[RESUME RENAME]")
+        print("+ Batch finished:", self.apply_rename_journal(forward=True), "files renamed")
+        print()
 
-            # print(short_code_entries)
-            short_code_entries = set(short_code_entries)
-            short_code_entries.remove(None)
-            return short_code_entries
+    @traced
+    def rollback_rename(self):
+        print("[ROLLBACK RENAME]")
+        print("+ Batch undone:", self.apply_rename_journal(forward=False), "files renamed back")
+        print()
 
+    def rewrite_bibtex_keys(self, category_name, rename, output_file_path=None):
+        # Rename entries of a .bib file that is in the form check writes, streaming it through a memory map: only the
+        # renamed entries are decoded, and all entries are written sorted by short code as the rename methods do.
+        # rename(short code) returns the new short code or None. Returns the number of entries renamed, or None if the
+        # file has to be parsed instead
+        bibtex_file_path = os.path.join(self.bibtex_path, category_name + ".bib")
+        fingerprint = self.load_manifest()["bib"].get(category_name)
+        if not same_fingerprint(fingerprint, file_fingerprint(bibtex_file_path, fingerprint)):
+            return None
+        entries = []
+        with BibtexEntryReader(bibtex_file_path) as reader:
+            blocks = list(reader)
+            for i, (entry_type, short_code, start, end) in enumerate(blocks):
+                # the entries are separated by two empty lines
+                if i < len(blocks) - 1:
+                    if reader.read(end - 3, end) != b"\n\n\n": return None
+                    end -= 3
+                if short_code is None or reader.find(b"\n\n\n", start, end) != -1: return None
+                entries.append([short_code, start, end, None])
+        for entry in entries:
+            entry[3] = rename(entry[0])
+        with BibtexEntryWriter(output_file_path or bibtex_file_path, separator="\n\n\n") as writer:
+            with BibtexEntryReader(bibtex_file_path) as reader:
+                for short_code, start, end, short_code_new in sorted(entries, key=lambda x: x[3] or x[0]):
+                    if short_code_new is None:
+                        writer.write(reader.read(start, end))
+                    else:
+                        left, right = reader.read(start, end).decode("utf-8").split("{", 1)
+                        writer.write(left.lower() + "{" + short_code_new + "," + right.split(",", 1)[1])
+        return sum(entry[3] is not None for entry in entries)
+
+    @traced
+    def find_duplicates(self, threshold=0.8, bands=16, rows=4, report="DuplicateReport.md"):
+        # Clusters of entries that may be the same publication: the same DOI, the same normalized title, or titles and
+        # authors whose MinHash signatures are similar. Similar signatures are found by LSH, hashing bands of rows of
+        # each signature, so entries are only compared within a bucket. Signatures are cached by the text they are
+        # computed from, so only new or changed entries are hashed again, and the similar pairs of each bucket are
+        # cached with its signatures, so only the buckets holding a new signature are compared again
+        print("[FIND DUPLICATES]")
+        import numpy as np
+        df = self.load_catalog()
+        signature_file_path = os.path.join(self.cache_path, "duplicate_signatures.pickle")
+        cache = load_pickle(signature_file_path, {})
+        if cache.get("parameters") != (bands, rows):
+            cache = {"parameters": (bands, rows), "signatures": {}}
+        if cache.get("threshold") != threshold:
+            cache["threshold"], cache["buckets"] = threshold, {}
+        random_state = np.random.RandomState(0)
+        permutations = (random_state.randint(1, 2 ** 31, bands * rows).astype(np.uint64),
+                        random_state.randint(0, 2 ** 31, bands * rows).astype(np.uint64))
+
+        keys, signatures, count_hashed = [], {}, 0
+        clusters = {}  # entry index -> cluster root, as a union-find
+
+        def find(i):
+            while clusters.setdefault(i, i) != i:
+                clusters[i] = clusters[clusters[i]]
+                i = clusters[i]
+            return i
+
+        reasons = {}
+
+        def union(i, j, reason):
+            clusters[find(i)] = find(j)
+            reasons.setdefault(i, set()).add(reason)
+            reasons.setdefault(j, set()).add(reason)
+
+        exact = {}
+        buckets = {}  # (band, rows of the signature) -> {text hash}
+        text_entries = {}  # text hash -> [entry index]
+        for i, (short_code, category_name, title, pdf_file, bibtex_string) in enumerate(
+                zip(df.index, df["Category"], df["Title"], df["f"], df["BibtexString"])):
+            fields = bibtex_fields(bibtex_string) if isinstance(bibtex_string, str) else {}
+            # the Title of the catalog is shortened, the title of an entry without BibTeX is taken from its PDF
+            if isinstance(pdf_file, str) and " " in pdf_file:
+                title = pdf_file.rsplit(".", 1)[0].split(" ", 1)[1]
+            title = normalize_text(fields.get("title", title))
+            authors = [normalize_text(author.split(",")[0]) for author in fields.get("author", "").split(" and ")]
+            doi = fields.get("doi", "").lower().replace("https://doi.org/", "").strip()
+            keys.append((short_code, category_name))
+            for reason, key in [("doi", doi), ("title", title if len(title) >= 10 else "")]:
+                if key:
+                    if (reason, key) in exact:
+                        union(exact[(reason, key)], i, reason)
+                    else:
+                        exact[(reason, key)] = i
+            if not title: continue
+            text = title + "|" + " ".join(authors)
+            text_hash = hash_string(text)
+            signature = cache["signatures"].get(text_hash)
+            if signature is None:
+                compact = title.replace(" ", "")
+                shingles = set(compact[k:k + 4] for k in range(max(len(compact) - 3, 1)))
+                shingles.update("author:" + author for author in authors if author)
+                signature = minhash_signature(shingles, permutations)
+                count_hashed += 1
+            signatures[text_hash] = signature
+            text_entries.setdefault(text_hash, []).append(i)
+            for band in range(bands):
+                buckets.setdefault((band, signature[band * rows:(band + 1) * rows].tobytes()), set()).add(text_hash)
+
+        # compare the signatures within each bucket, only the pairs with a signature new to the bucket
+        compared = {}  # (text hash, text hash) -> similar
+        similar_pairs = set()
+        bucket_cache = {}
+        for bucket_key, text_hashes in buckets.items():
+            cached = cache["buckets"].get(bucket_key, {"text hashes": set(), "similar": set()})
+            if cached["text hashes"] == text_hashes:
+                similar = cached["similar"]
+            else:
+                known = sorted(text_hashes.intersection(cached["text hashes"]))
+                new = sorted(text_hashes.difference(cached["text hashes"]))
+                similar = set(pair for pair in cached["similar"] if pair[0] in text_hashes and pair[1] in text_hashes)
+                for a, hash_a in enumerate(new):
+                    for hash_b in new[a + 1:] + known:
+                        pair = (min(hash_a, hash_b), max(hash_a, hash_b))
+                        if pair not in compared:
+                            compared[pair] = np.mean(signatures[pair[0]] == signatures[pair[1]]) >= threshold
+                        if compared[pair]:
+                            similar.add(pair)
+            if len(text_hashes) > 1:
+                bucket_cache[bucket_key] = {"text hashes": text_hashes, "similar": similar}
+            similar_pairs.update(similar)
+        # entries with the same text have the same signature
+        for entries in text_entries.values():
+            for j in entries[1:]:
+                union(entries[0], j, "similar")
+        for hash_a, hash_b in similar_pairs:
+            for i in text_entries[hash_a]:
+                for j in text_entries[hash_b]:
+                    union(i, j, "similar")
+        if count_hashed or len(signatures) != len(cache["signatures"]) or bucket_cache != cache["buckets"]:
+            cache["signatures"], cache["buckets"] = signatures, bucket_cache
+            if not os.path.exists(self.cache_path): os.makedirs(self.cache_path)
+            save_pickle(signature_file_path, cache)
+
+        groups = {}
+        for i in clusters:
+            groups.setdefault(find(i), []).append(i)
+        duplicates = []
+        for group in sorted((sorted(group) for group in groups.values() if len(group) > 1), key=lambda x: keys[x[0]]):
+            duplicates.append([{"short_code": keys[i][0], "category": keys[i][1],
+                                "reasons": sorted(reasons.get(i, ())),
+                                "pdf": df["f"].iloc[i] if isinstance(df["f"].iloc[i], str) else None,
+                                "images": list(df["Pf"].iloc[i]),
+                                "bibtex": df["BibtexString"].iloc[i] if isinstance(df["BibtexString"].iloc[i],
+                                                                                   str) else None}
+                               for i in group])
+
+        report_file_path = os.path.join(self.io_path, report)
+        with codecs.open(report_file_path, "w", "utf-8") as file:
+            file.write("# Duplicate candidates\n")
+            for cluster_i, cluster in enumerate(duplicates):
+                file.write("\n## Cluster {}\n".format(cluster_i + 1))
+                for item in cluster:
+                    file.write("\n- {} :: {} ({})\n".format(item["category"], item["short_code"],
+                                                            ", ".join(item["reasons"])))
+                    for file_name in ([item["pdf"]] if item["pdf"] else []) + item["images"]:
+                        file.write("  - {}\n".format(file_name))
+                    if item["bibtex"]:
+                        file.write("\n```bibtex\n{}\n```\n".format(item["bibtex"].strip()))
+        trace_written(report_file_path)
+        trace_count("entries hashed", count_hashed)
+        trace_count("pairs compared", len(compared))
+        print("+ Signatures of", count_hashed, "entries computed,", len(compared), "pairs compared")
+        print("+ Duplicate candidates:", len(duplicates), "clusters of", sum(len(cluster) for cluster in duplicates),
+              "entries")
+        print("+ Report saved in", report_file_path)
+        print()
+        return duplicates
+
+    def update_short_code_index(self, category_names, reindex=(), snapshot=None):
+        # {category: {"fingerprint": ..., "entries": {short code: (byte offset, length, content hash)}, "strings": ...}},
+        # indexing again only the .bib files whose fingerprint changed. The stats of a fresh snapshot save a round trip
+        # per file
+        short_code_index_file_path = os.path.join(self.cache_path, "short_code_index.pickle")
+        short_code_index = load_pickle(short_code_index_file_path, {})
+        changed = False
+        for category_name in category_names:
+            bibtex_file_path = os.path.join(self.bibtex_path, category_name + ".bib")
+            record = short_code_index.get(category_name, {})
+            previous = None if category_name in reindex or "strings" not in record else record["fingerprint"]
+            if snapshot is not None:
+                fingerprint = snapshot.bibtex_file_fingerprint(category_name, previous)
+            else:
+                fingerprint = file_fingerprint(bibtex_file_path, previous)
+            if fingerprint is previous:
+                continue
+            changed = True
+            if same_fingerprint(previous, fingerprint):
+                short_code_index[category_name]["fingerprint"] = fingerprint
+            else:
+                entries, strings = index_bibtex_file(bibtex_file_path)
+                short_code_index[category_name] = {"fingerprint": fingerprint, "entries": entries, "strings": strings}
+        if changed:
+            if not os.path.exists(self.cache_path): os.makedirs(self.cache_path)
+            save_pickle(short_code_index_file_path, short_code_index)
+        return short_code_index
+
+    def update_short_code_registry(self, snapshot=None):
+        # The registry of the short codes of all categories and additional categories, reading again only the .bib
+        # files and PDF folders whose fingerprint changed. snapshot is a fresh Bib.scan, made here if not given
+        snapshot = snapshot or self.scan()
+        registry = self.short_code_registry
+        registry.load()
+        bib_categories = [category_name for category_name in self.inspect_categories + self.additional_categories
+                          if category_name + ".bib" in snapshot.bib_files]
+        short_code_index = self.update_short_code_index(bib_categories, snapshot=snapshot)
+        sources = set()
+        for category_name in bib_categories:
+            source = ("bib", category_name)
+            sources.add(source)
+            record = registry.sources.get(source)
+            fingerprint = short_code_index[category_name]["fingerprint"]
+            if record is not None and same_fingerprint(record["fingerprint"], fingerprint):
+                if record["fingerprint"] != fingerprint:
+                    record["fingerprint"], registry.changed = fingerprint, True
+                continue
+            registry.set_source(source, fingerprint,
+                                {short_code: [] for short_code in short_code_index[category_name]["entries"]})
+            trace_count("sources indexed")
+        for category_name in self.inspect_categories:
+            if category_name not in snapshot.folders: continue
+            source = ("folder", category_name)
+            sources.add(source)
+            record = registry.sources.get(source)
+            fingerprint, file_names = snapshot.folder_fingerprint(category_name,
+                                                                  record["fingerprint"] if record else None)
+            if file_names is None: continue
+            if record is not None and same_fingerprint(record["fingerprint"], fingerprint):
+                record["fingerprint"], registry.changed = fingerprint, True
+                continue
+            short_codes = {}
+            for file_name in file_names:
+                if " " not in file_name: continue
+                short_codes.setdefault(file_name.split(" ", 1)[0], []).append(file_name)
+            registry.set_source(source, fingerprint, short_codes)
+            trace_count("sources indexed")
+        for source in [source for source in registry.sources if source not in sources]:
+            registry.set_source(source, None, None)
+        registry.save()
+        return registry
+
+    def read_indexed_entries(self, category_name, short_codes, short_code_index, retry=True):
+        bibtex_file_path = os.path.join(self.bibtex_path, category_name + ".bib")
+        entries = []
+        with open(bibtex_file_path, "rb") as file:
+            for short_code in short_codes:
+                offset, length, content_hash = short_code_index[category_name]["entries"][short_code]
+                file.seek(offset)
+                data = file.read(length)
+                if hashlib.sha1(data).hexdigest() != content_hash:
+                    if not retry:
+                        raise NameError("Short code index of " + bibtex_file_path + " is inconsistent")
+                    # the file changed since it was indexed
+                    short_code_index.update(self.update_short_code_index([category_name], reindex=[category_name]))
+                    short_codes = [short_code for short_code in short_codes
+                                   if short_code in short_code_index[category_name]["entries"]]
+                    return self.read_indexed_entries(category_name, short_codes, short_code_index, retry=False)
+                entries.append(data.decode("utf-8").strip())
+        return entries
+
+    def read_parsed_entries(self, category_name, short_codes):
+        # the first entry of each short code, written alone after parsing the whole .bib file
+        with codecs.open(os.path.join(self.bibtex_path, category_name + ".bib"), 'r', "utf-8") as file:
+            bib_database = bibtexparser.parse_string(file.read())
+        entries = {}
+        for entry in bib_database.entries:
+            if entry.key in short_codes and entry.key not in entries:
+                entries[entry.key] = bibtexparser.write_string(bibtexparser.Library([entry])).strip()
+        trace_count("entries parsed", len(bib_database.entries))
+        return [entries[short_code] for short_code in short_codes if short_code in entries]
+
+    def collect_typst_citations(self, input="input.typ"):
+        # Short codes cited in a Typst file and the files it includes, following #include "..." recursively. As in
+        # Typst, an include starting with "/" is found from the project root, the folder of the main file.
+        # The citations of each file are cached by fingerprint, so only changed files are scanned again
+        cache_file_path = os.path.join(self.cache_path, "typst_citations.pickle")
+        cache = load_pickle(cache_file_path, {})
+        changed = False
+        citations = set()
+        visited = set()
+        to_visit = [os.path.abspath(os.path.join(self.io_path, input))]
+        project_path = os.path.dirname(to_visit[0])
+        while to_visit:
+            typst_file_path = to_visit.pop()
+            if typst_file_path in visited: continue
+            visited.add(typst_file_path)
+            if not os.path.isfile(typst_file_path):
+                print("- Included file not found:", typst_file_path)
+                continue
+            cached = cache.get(typst_file_path, {})
+            fingerprint = file_fingerprint(typst_file_path, cached.get("fingerprint"))
+            if not same_fingerprint(cached.get("fingerprint"), fingerprint) or "include names" not in cached:
+                with codecs.open(typst_file_path, 'r', 'utf-8') as file:
+                    input_data = file.read()
+                cached = {"citations": collect_short_code_from_typst(input_data),
+                          "include names": TYPST_INCLUDE_PATTERN.findall(input_data)}
+            if cached.get("fingerprint") is not fingerprint:
+                cached["fingerprint"] = fingerprint
+                cache[typst_file_path] = cached
+                changed = True
+            citations.update(cached["citations"])
+            folder_path = os.path.dirname(typst_file_path)
+            to_visit += [os.path.abspath(os.path.join(project_path, include.lstrip("/")) if include.startswith("/") else
+                                         os.path.join(folder_path, include))
+                         for include in cached["include names"]][::-1]
+        if changed:
+            if not os.path.exists(self.cache_path): os.makedirs(self.cache_path)
+            save_pickle(cache_file_path, cache)
+        return citations
+
+    @traced
+    def select_from_typst(self, input="input.typ", output="selected.bib", watch=False, poll_interval=1.0):
         # extract used shortcodes
-        with codecs.open(os.path.join(self.io_path, input), 'r', 'utf-8') as file:
-            input_data = file.read()
+        short_code_entries = self.collect_typst_citations(input)
+        self.write_selected_bibtex(set(short_code_entries), output)
+        if not watch: return
 
-        short_code_entries = collect_short_code_from_typst(input_data)
+        print("[SELECT FROM TYPST WATCH]")
+        try:
+            while True:
+                time.sleep(poll_interval)
+                new_short_code_entries = self.collect_typst_citations(input)
+                if new_short_code_entries != short_code_entries:
+                    # only a change of the citations changes the selection
+                    short_code_entries = new_short_code_entries
+                    self.write_selected_bibtex(set(short_code_entries), output)
+                    print()
+                    print("[SELECT FROM TYPST WATCH]")
+        except KeyboardInterrupt:
+            pass
+
+    def write_selected_bibtex(self, short_code_entries, output="selected.bib"):
         print("+ Number of references in input:", len(short_code_entries))
         # print(short_code_entries)
         collected_bib = []
-        bibtex_path = self.bibtex_path
-        for category_file in os.listdir(bibtex_path):
-            bibtex_file_path = os.path.join(bibtex_path, category_file)
-            if os.path.isfile(bibtex_file_path):
-                category_name = category_file[:-4]
-                # print(category_name)
-                if not (
-                        category_name in self.inspect_categories or category_name in self.additional_categories): continue
-
-                # if category_name not in inspect_categories: continue
-                count = 0
-                # Format and sort the BibTeX entries
-                with codecs.open(bibtex_file_path, 'r', 'utf-8') as file:
-                    bibtex_data = file.read()
-                if category_name in self.additional_categories:
-                    bibtex_data = main_parser(bibtex_data)
-                entries = bibtex_data.split('\n\n\n')
-                for entry in entries:
-                    bib_type, short_code = entry.split("{", 1)
-                    short_code = short_code.split(",", 1)[0]
-                    # print(short_code)
-                    if short_code in short_code_entries:
-                        count += 1
-                        collected_bib.append(entry)
-                        short_code_entries.remove(short_code)
-                if count > 0:
-                    print("+ Collected", count, "entries from category: ", category_name)
+        category_names = [category_file[:-4] for category_file in os.listdir(self.bibtex_path)
+                          if os.path.isfile(os.path.join(self.bibtex_path, category_file)) and (
+                                  category_file[:-4] in self.inspect_categories or
+                                  category_file[:-4] in self.additional_categories)]
+        short_code_index = self.update_short_code_index(category_names)
+        for category_name in category_names:
+            # Seek and read only the cited entries
+            short_codes = sorted(short_code_entries.intersection(short_code_index[category_name]["entries"]))
+            if not short_codes: continue
+            if short_code_index[category_name]["strings"]:
+                # the @string macros used by the entries are only resolved by a full parse of the file
+                entries = self.read_parsed_entries(category_name, short_codes)
+            else:
+                entries = self.read_indexed_entries(category_name, short_codes, short_code_index)
+            if category_name in self.additional_categories:
+                # Format the BibTeX entries
+                entries = self.parse_bibtex('\n\n'.join(entries)).split('\n\n\n')
+            collected_bib += entries
+            short_code_entries.difference_update(short_codes)
+            print("+ Collected", len(entries), "entries from category: ", category_name)
         print("+ In total, collected", len(collected_bib), "entries")
         if short_code_entries:
             print("- Remaining references:", short_code_entries)
         # Write the selected BibTeX entries to a new file
-        new_bibtex = main_parser('\n\n\n'.join(collected_bib))
-        with codecs.open(os.path.join(self.io_path, output), 'w', "utf-8") as file:
-            file.write(new_bibtex)
-
-        with codecs.open(os.path.join(self.io_path, output[:-4] + "_latex.bib"), 'w', 'utf-8') as file:
-            file.write(latex_encode(new_bibtex))
+        new_bibtex = self.parse_bibtex('\n\n\n'.join(collected_bib))
+        write_if_changed(os.path.join(self.io_path, output), new_bibtex)
+        write_if_changed(os.path.join(self.io_path, output[:-4] + "_latex.bib"), self.encode_bibtex(new_bibtex))
@@ -0,0 +1,194 @@
+import time
+
+STARTED = time.perf_counter()
+
+import os
+import sys
+import json
+import argparse
+
+CONFIG_FILE = "bibgallery.json"
+# seconds from the start of the CLI to the start of the command. Over the budget, a warning names the heavy modules that
+# were imported, as these commands should not need them
+STARTUP_BUDGETS = {"select": 0.5, "latex": 0.5, "rename": 0.5}
+HEAVY_MODULES = ["pandas", "numpy", "pdf2bib", "pymupdf", "fitz", "watchdog"]
+BIB_ARGUMENTS = ["inspect_categories", "root_folder_path", "additional_categories", "bibtex_folder",
+                 "bibtex_latex_folder", "pdf_folder", "html_folder", "pdf_collect_folder", "io_folder", "cache_folder",
+                 "workers", "normalization_cache_size", "sqlite_catalog", "scan_threads", "trace"]
+
+
+def load_config(config_file_path):
+    # Bib arguments, and options of the commands under their names, e.g.
+    # {"inspect_categories": ["Robotics"], "additional_categories": ["TENG"], "check": {"show_incomplete": false}}
+    if not os.path.exists(config_file_path):
+        raise NameError("No configuration file " + config_file_path + ", see the CLI section of README.md")
+    with open(config_file_path, encoding="utf-8") as file:
+        config = json.load(file)
+    if "inspect_categories" not in config:
+        raise NameError("No inspect_categories in " + config_file_path)
+    return config
+
+
+def options(config, command, arguments, names):
+    # Options of a command from the configuration, overridden by the arguments given on the command line
+    result = dict(config.get(command, {}))
+    for name in names:
+        value = getattr(arguments, name)
+        if value is not None:
+            result[name] = value
+    return result
+
+
+def run_check(bib, config, arguments):
+    bib.check(**options(config, "check", arguments, ["update_bibtex", "show_incomplete", "check_books", "incremental",
+                                                     "reports", "report_columns"]))
+
+
+def run_collect(bib, config, arguments):
+    collect_options = options(config, "collect", arguments, ["threads", "enforce"])
+    if arguments.batch is not None:
+        bib.collect_batch(review=arguments.batch, **collect_options)
+    elif arguments.apply is not None:
+        bib.collect_apply(review=arguments.apply)
+    else:
+        bib.collect(**collect_options)
+
+
+def run_html(bib, config, arguments):
+    bib.generate_html_files(**options(config, "html", arguments, ["thumbnail_height", "thumbnail_threads", "page_size",
+                                                                  "page_by", "search"]))
+
+
+def run_watch(bib, config, arguments):
+    bib.check(**config.get("check", {}))
+    bib.generate_html_files(**config.get("html", {}))
+    bib.gallery_watch(**options(config, "watch", arguments, ["quiet_period"]))
+
+
+def run_serve(bib, config, arguments):
+    # the options of html apply to the served gallery too
+    serve_options = dict(config.get("html", {}))
+    serve_options.update(options(config, "serve", arguments, ["host", "port", "watch", "quiet_period"]))
+    bib.serve(**serve_options)
+
+
+def run_select(bib, config, arguments):
+    bib.select_from_typst(**options(config, "select", arguments, ["input", "output", "watch", "poll_interval"]))
+
+
+def run_rename(bib, config, arguments):
+    if arguments.resume:
+        bib.resume_rename()
+    elif arguments.rollback:
+        bib.rollback_rename()
+    elif not (arguments.theme or arguments.short_code or arguments.mapping):
+        raise NameError("Nothing to rename, give --theme, --short-code or --mapping")
+    else:
+        bib.batch_rename(themes=dict(arguments.theme or []), short_codes=dict(arguments.short_code or []),
+                         mapping_file=arguments.mapping)
+
+
+def run_latex(bib, config, arguments):
+    bib.update_latex()
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog="bibgallery", description="Manage a BibGallery library")
+    parser.add_argument("--config", default=CONFIG_FILE, help="JSON configuration file, default: " + CONFIG_FILE)
+    parser.add_argument("--workers", type=int, default=None, help="workers of Bib, overrides the configuration")
+    parser.add_argument("--trace", action="store_true", default=None, help="time the phases of the command")
+    parser.add_argument("--timing", action="store_true", help="print the startup time and the heavy modules imported")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("check", help="check the BibTeX files and PDF folders")
+    command.set_defaults(run=run_check)
+    command.add_argument("--update-bibtex", default=None, metavar="FILE",
+                         help="BibTeX file in io whose entries replace those of the library")
+    command.add_argument("--show-incomplete", action=argparse.BooleanOptionalAction, default=None,
+                         help="list the entries with incomplete BibTeX")
+    command.add_argument("--check-books", action="store_true", default=None, help="also check the book chapters")
+    command.add_argument("--full", dest="incremental", action="store_false", default=None,
+                         help="parse every category, ignoring the cache")
+    command.add_argument("--reports", nargs="*", choices=["all", "non_books", "csv"], default=None,
+                         help="reports to write, default: all of them")
+    command.add_argument("--report-columns", nargs="+", default=None, metavar="COLUMN",
+                         help="columns of the reports, default: all but BibtexString")
+
+    command = commands.add_parser("collect", help="add the PDFs of to_collect to the library")
+    command.set_defaults(run=run_collect)
+    command.add_argument("--threads", type=int, default=None, help="threads resolving the PDFs, default: 8")
+    command.add_argument("--enforce", action="store_true", default=None,
+                         help="add -2, -3, ... to colliding short codes instead of stopping")
+    group = command.add_mutually_exclusive_group()
+    group.add_argument("--batch", nargs="?", const="collect_review.json", default=None, metavar="REVIEW",
+                       help="only write the proposals to a review file in io")
+    group.add_argument("--apply", nargs="?", const="collect_review.json", default=None, metavar="REVIEW",
+                       help="apply the approved proposals of a review file in io")
+
+    command = commands.add_parser("html", help="generate the gallery")
+    command.set_defaults(run=run_html)
+    command.add_argument("--thumbnail-height", type=int, default=None, help="height of the thumbnails, default: 400")
+    command.add_argument("--thumbnail-threads", type=int, default=None, help="threads rendering the thumbnails")
+    command.add_argument("--page-size", type=int, default=None, help="entries or images per page")
+    command.add_argument("--page-by", choices=["entries", "images"], default=None, help="unit of --page-size")
+    command.add_argument("--search", action=argparse.BooleanOptionalAction, default=None,
+                         help="add the full-text search box")
+
+    command = commands.add_parser("watch", help="check, generate the gallery and keep it updated")
+    command.set_defaults(run=run_watch)
+    command.add_argument("--quiet-period", type=float, default=None, help="seconds without events before a rebuild")
+
+    command = commands.add_parser("serve", help="serve the gallery on a local HTTP server with live reload")
+    command.set_defaults(run=run_serve)
+    command.add_argument("--host", default=None, help="default: 127.0.0.1")
+    command.add_argument("--port", type=int, default=None, help="default: 8000")
+    command.add_argument("--watch", action=argparse.BooleanOptionalAction, default=None,
+                         help="update the served gallery when the library changes, default: on")
+    command.add_argument("--quiet-period", type=float, default=None, help="seconds without events before an update")
+
+    command = commands.add_parser("select", help="select the BibTeX entries cited by a Typst document")
+    command.set_defaults(run=run_select)
+    command.add_argument("--input", default=None, help="Typst file in io, default: input.typ")
+    command.add_argument("--output", default=None, help="BibTeX file in io, default: selected.bib")
+    command.add_argument("--watch", action="store_true", default=None, help="select again when the document changes")
+    command.add_argument("--poll-interval", type=float, default=None, help="seconds between checks of --watch")
+
+    command = commands.add_parser("rename", help="rename themes and short codes")
+    command.set_defaults(run=run_rename)
+    command.add_argument("--theme", nargs=2, action="append", metavar=("OLD", "NEW"), help="rename a theme")
+    command.add_argument("--short-code", nargs=2, action="append", metavar=("OLD", "NEW"),
+                         help="rename a short code")
+    command.add_argument("--mapping", default=None, metavar="CSV", help="CSV file in io of kind,old,new renames")
+    group = command.add_mutually_exclusive_group()
+    group.add_argument("--resume", action="store_true", help="finish an interrupted batch rename")
+    group.add_argument("--rollback", action="store_true", help="undo an interrupted batch rename")
+
+    command = commands.add_parser("latex", help="update the LaTeX-encoded BibTeX files")
+    command.set_defaults(run=run_latex)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    config = load_config(arguments.config)
+    bib_arguments = {name: config[name] for name in BIB_ARGUMENTS if name in config}
+    for name in ["workers", "trace"]:
+        if getattr(arguments, name) is not None:
+            bib_arguments[name] = getattr(arguments, name)
+
+    from Bib import Bib
+    bib = Bib(**bib_arguments)
+    startup = time.perf_counter() - STARTED
+    heavy_modules = [name for name in HEAVY_MODULES if name in sys.modules]
+    budget = STARTUP_BUDGETS.get(arguments.command)
+    if arguments.timing:
+        print("[TIMING] startup {:.3f}s".format(startup) + (" of {:.3f}s".format(budget) if budget else "") +
+              ", heavy modules: " + (", ".join(heavy_modules) or "none"))
+    if budget is not None and startup > budget:
+        print("- Startup took {:.3f}s, over the budget of {:.3f}s of {}".format(startup, budget, arguments.command) +
+              (", heavy modules imported: " + ", ".join(heavy_modules) if heavy_modules else ""))
+    arguments.run(bib, config, arguments)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Benchmark import generate_library  # noqa: E402
+
+
+def pytest_addoption(parser):
+    parser.addoption("--slow", action="store_true", help="also run the slow tests, such as the 50,000 entry scaling")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: slow test, only run with --slow")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--slow"): return
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(pytest.mark.skip(reason="slow, run with --slow"))
+
+
+@pytest.fixture
+def library(tmp_path):
+    # (root, category names) of a small synthetic library, see Benchmark.generate_library
+    root = str(tmp_path / "library")
+    return root, generate_library(root, 2, 20, 2)
@@ -0,0 +1,282 @@
+import os
+import json
+import shutil
+import contextlib
+import io
+
+import pytest
+
+import Bib as Bib_module
+from Bib import Bib
+from Benchmark import generate_library, seconds_per_entry, SCALING_SIZES, SCALING_TOLERANCE
+
+
+def quiet(method, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return method(*args, **kwargs)
+
+
+def phase_counter(span, phase, name):
+    return sum(child["counters"].get(name, 0) for child in span["children"] if child["name"] == phase)
+
+
+def span_totals(span, totals=None):
+    # the counters of a span and of all its children
+    totals = {} if totals is None else totals
+    for name, value in span["counters"].items():
+        totals[name] = totals.get(name, 0) + value
+    for child in span["children"]:
+        span_totals(child, totals)
+    return totals
+
+
+def test_check_visits_each_entry_once(tmp_path):
+    per_entry = []
+    for entries in [100, 400]:
+        root = str(tmp_path / str(entries))
+        category_names = generate_library(root, 2, entries, 1)
+        bib = Bib(category_names, root_folder_path=root, io_folder="io", trace=True)
+        quiet(bib.check)
+        totals = span_totals(bib.instrumentation.spans[-1])
+        count = 2 * entries
+        assert totals["entries"] == totals["entries parsed"] == totals["files scanned"] == count
+        assert totals["files read"] == totals["folders listed"] == 2
+        per_entry.append(totals["bytes written"] / count)
+    assert per_entry[1] / per_entry[0] < 1.05
+
+
+@pytest.mark.slow
+def test_check_time_per_entry_is_the_same_at_50000_entries(tmp_path):
+    # cold checks of 12,500 and 50,000 entries, see Benchmark.py --scaling
+    per_entry = seconds_per_entry("check", SCALING_SIZES, str(tmp_path), {"workers": 1})
+    assert per_entry[-1] / per_entry[0] <= SCALING_TOLERANCE
+
+
+def test_update_latex_counts_bytes_written_once(library):
+    root, category_names = library
+    bib = Bib(category_names, root_folder_path=root, io_folder="io", trace=True)
+    quiet(bib.update_latex)
+    latex_path = os.path.join(root, "bib_latex")
+    expected = sum(os.path.getsize(os.path.join(latex_path, file_name)) for file_name in os.listdir(latex_path))
+    assert phase_counter(bib.instrumentation.spans[-1], "write", "bytes written") == expected
+    # nothing changed, nothing is written
+    quiet(bib.update_latex)
+    assert phase_counter(bib.instrumentation.spans[-1], "write", "bytes written") == 0
+
+
+def test_collect_apply_uses_the_edited_short_code(library):
+    root, category_names = library
+    category_name = category_names[0]
+    collect_path = os.path.join(root, "to_collect", category_name)
+    os.makedirs(collect_path)
+    pdf_path = os.path.join(root, "PDF", category_name)
+    shutil.copyfile(os.path.join(pdf_path, sorted(os.listdir(pdf_path))[0]), os.path.join(collect_path, "Origami.pdf"))
+
+    def resolver(pdf_file_path):
+        return "@article{key,\n  title = {Folded plates},\n  author = {Smith, John},\n  year = {2001}\n}\n"
+
+    bib = Bib(category_names, root_folder_path=root, io_folder="io")
+    quiet(bib.collect_batch, resolver=resolver)
+    review_file_path = os.path.join(root, "io", "collect_review.json")
+    with open(review_file_path, encoding="utf-8") as file:
+        items = json.load(file)
+    assert items[0]["approve"] and items[0]["short_code"] == "Smith-2001-Origami"
+    items[0]["short_code"] = "Smith-2001-Curved-Folding"
+    with open(review_file_path, "w", encoding="utf-8") as file:
+        json.dump(items, file)
+    quiet(bib.collect_apply)
+
+    assert os.path.exists(os.path.join(pdf_path, "Smith-2001-Curved-Folding Folded plates.pdf"))
+    with open(os.path.join(root, "bib", category_name + ".bib"), encoding="utf-8") as file:
+        bibtex = file.read()
+    assert "{Smith-2001-Curved-Folding," in bibtex and "{Smith-2001-Origami," not in bibtex
+    assert "Smith-2001-Curved-Folding" in bib.short_code_registry
+
+
+def collect_two_categories(root, category_names):
+    # review file of one approved PDF in to_collect of each of the first two categories
+    for category_name, title in zip(category_names, ["Origami", "Kirigami"]):
+        collect_path = os.path.join(root, "to_collect", category_name)
+        os.makedirs(collect_path)
+        pdf_path = os.path.join(root, "PDF", category_name)
+        shutil.copyfile(os.path.join(pdf_path, sorted(os.listdir(pdf_path))[0]),
+                        os.path.join(collect_path, title + ".pdf"))
+
+    def resolver(pdf_file_path):
+        title = os.path.basename(pdf_file_path)[:-4]
+        return "@article{key,\n  title = {" + title + "},\n  author = {Smith, John},\n  year = {2001}\n}\n"
+
+    bib = Bib(category_names, root_folder_path=root, io_folder="io")
+    quiet(bib.collect_batch, resolver=resolver)
+    return bib
+
+
+def read_review(root):
+    with open(os.path.join(root, "io", "collect_review.json"), encoding="utf-8") as file:
+        return json.load(file)
+
+
+def read_bibtex(root, category_name):
+    with open(os.path.join(root, "bib", category_name + ".bib"), encoding="utf-8") as file:
+        return file.read()
+
+
+def test_collect_apply_skips_an_item_without_pdf_folder(library):
+    root, category_names = library
+    bib = collect_two_categories(root, category_names)
+    shutil.rmtree(os.path.join(root, "PDF", category_names[1]))
+    quiet(bib.collect_apply)
+
+    assert os.path.exists(os.path.join(root, "PDF", category_names[0], "Smith-2001-Origami Origami.pdf"))
+    assert "{Smith-2001-Origami," in read_bibtex(root, category_names[0])
+    assert os.path.exists(os.path.join(root, "to_collect", category_names[1], "Kirigami.pdf"))
+    assert [(item["pdf"], item["approve"]) for item in read_review(root)] == [("Kirigami.pdf", True)]
+
+
+def test_collect_apply_keeps_the_bibtex_of_moved_pdfs_when_a_move_fails(library, monkeypatch):
+    root, category_names = library
+    bib = collect_two_categories(root, category_names)
+    # the move of the second item of the review file fails, after the first PDF was moved
+    first, second = read_review(root)
+    move_file = Bib_module.move_file
+
+    def failing_move_file(source_path, destination_path):
+        if source_path.endswith(second["pdf"]):
+            raise NameError("Error: disk full")
+        move_file(source_path, destination_path)
+
+    monkeypatch.setattr(Bib_module, "move_file", failing_move_file)
+    with pytest.raises(NameError):
+        quiet(bib.collect_apply)
+
+    assert "{" + first["short_code"] + "," in read_bibtex(root, first["category"])
+    assert second["short_code"] not in read_bibtex(root, second["category"])
+    assert [item["pdf"] for item in read_review(root)] == [second["pdf"]]
+    # the rerun collects the remaining item only
+    monkeypatch.setattr(Bib_module, "move_file", move_file)
+    quiet(bib.collect_apply)
+    assert "{" + second["short_code"] + "," in read_bibtex(root, second["category"])
+    assert read_bibtex(root, first["category"]).count("{" + first["short_code"] + ",") == 1
+    assert read_review(root) == []
+
+
+def test_sqlite_catalog_follows_the_checked_categories_and_updated_bibtex(library):
+    root, category_names = library
+    quiet(Bib(category_names, root_folder_path=root, io_folder="io", sqlite_catalog=True).check)
+    bib = Bib(category_names[:1], root_folder_path=root, io_folder="io", sqlite_catalog=True)
+    quiet(bib.check)
+    rows = bib.query()
+    assert rows and set(row["category"] for row in rows) == {category_names[0]}
+
+    short_code = rows[0]["short_code"]
+    with open(os.path.join(root, "io", "update.bib"), "w", encoding="utf-8") as file:
+        file.write("@article{" + short_code + ",\n  title = {An updated title},\n}\n")
+    quiet(bib.check, update_bibtex="update.bib")
+    assert "An updated title" in bib.query(short_code=short_code)[0]["bibtex"]
+
+
+def test_find_duplicates_uses_the_whole_title_of_pdfs_without_bibtex(library):
+    root, category_names = library
+    title = "Folded plate structures with curved creases for deployable shelters in architecture"
+    with open(os.path.join(root, "bib", category_names[0] + ".bib"), "a", encoding="utf-8") as file:
+        file.write("\n\n@article{Smith-2001-Plates,\n  title = {" + title + "},\n  author = {Smith, John},\n}\n")
+    pdf_path = os.path.join(root, "PDF", category_names[1])
+    shutil.copyfile(os.path.join(pdf_path, sorted(os.listdir(pdf_path))[0]),
+                    os.path.join(pdf_path, "Smith-2001-Shelters " + title + ".pdf"))
+    bib = Bib(category_names, root_folder_path=root, io_folder="io")
+    quiet(bib.check)
+    duplicates = quiet(bib.find_duplicates)
+    assert [sorted(item["short_code"] for item in cluster) for cluster in duplicates] == [
+        ["Smith-2001-Plates", "Smith-2001-Shelters"]]
+
+
+def test_batch_rename_checks_the_short_codes_of_additional_categories(library):
+    root, category_names = library
+    bib = Bib(category_names[:1], root_folder_path=root, io_folder="io", additional_categories=category_names[1:])
+    short_code = sorted(os.listdir(os.path.join(root, "PDF", category_names[0])))[0].split(" ", 1)[0]
+    with open(os.path.join(root, "bib", category_names[1] + ".bib"), encoding="utf-8") as file:
+        taken = file.read().split("{", 1)[1].split(",", 1)[0]
+    bibtex_file_path = os.path.join(root, "bib", category_names[0] + ".bib")
+    with open(bibtex_file_path, encoding="utf-8") as file:
+        bibtex = file.read()
+    with pytest.raises(NameError, match=taken):
+        quiet(bib.batch_rename, short_codes={short_code: taken})
+    # nothing was journaled or renamed
+    assert not os.path.exists(os.path.join(bib.cache_path, "rename_journal", "journal.json"))
+    with open(bibtex_file_path, encoding="utf-8") as file:
+        assert file.read() == bibtex
+
+
+def test_collect_typst_citations_finds_includes_from_the_project_root(library):
+    root, category_names = library
+    chapters_path = os.path.join(root, "io", "chapters")
+    os.makedirs(chapters_path)
+    for file_path, text in [(os.path.join(root, "io", "input.typ"), '#include "chapters/a.typ"\n'),
+                            (os.path.join(chapters_path, "a.typ"), '@Smith-2001-Plates\n#include "/chapters/b.typ"\n'),
+                            (os.path.join(chapters_path, "b.typ"), '@Lee-2002-Shells\n')]:
+        with open(file_path, "w", encoding="utf-8") as file:
+            file.write(text)
+    bib = Bib(category_names, root_folder_path=root, io_folder="io")
+    assert quiet(bib.collect_typst_citations) == {"Smith-2001-Plates", "Lee-2002-Shells"}
+
+
+def test_select_from_typst_reads_entries_at_their_real_starts(library):
+    root, category_names = library
+    with open(os.path.join(root, "bib", "Extra.bib"), "w", encoding="utf-8") as file:
+        file.write('@string{tsl = "Transactions on Shells"}\n\n'
+                   '@comment{Folded-2001-Ghost is not an entry\n@article{Folded-2001-Ghost,}\n}\n\n'
+                   '@article{Folded-2001-Plates,\n  title = {Folded plates},\n  journal = tsl,\n}\n\n'
+                   '@article{Folded-2002-Shells,\n  title = {Shells},\n'
+                   '  abstract = {A line of the abstract\n@misc{Folded-2002-Inside, } starts with @}\n}\n')
+    with open(os.path.join(root, "io", "input.typ"), "w", encoding="utf-8") as file:
+        file.write("@Folded-2001-Plates @Folded-2001-Ghost @Folded-2002-Inside\n")
+    bib = Bib(category_names, root_folder_path=root, io_folder="io", additional_categories=["Extra"])
+    short_code_index = bib.update_short_code_index(["Extra"])
+    assert sorted(short_code_index["Extra"]["entries"]) == ["Folded-2001-Plates", "Folded-2002-Shells"]
+    assert short_code_index["Extra"]["strings"]
+    # the entry using the @string macro is read by a full parse of the file
+    quiet(bib.select_from_typst)
+    with open(os.path.join(root, "io", "selected.bib"), encoding="utf-8") as file:
+        selected = file.read()
+    assert "{Folded-2001-Plates," in selected and "Transactions on Shells" in selected
+    assert "Folded-2001-Ghost" not in selected and "Folded-2002-Inside" not in selected
+
+
+def test_trace_keeps_the_last_spans_and_the_counts_of_worker_threads(library, monkeypatch):
+    root, category_names = library
+    monkeypatch.setattr(Bib_module, "TRACE_MAX_SPANS", 3)
+    bib = Bib(category_names, root_folder_path=root, io_folder="io", trace=True)
+    for _ in range(5):
+        quiet(bib.update_latex)
+    with open(os.path.join(bib.cache_path, "trace.json"), encoding="utf-8") as file:
+        assert len(json.load(file)["spans"]) == 3
+
+    def work(value):
+        Bib_module.trace_count("items", value)
+        return value
+
+    with bib.instrumentation.span("work"):
+        with Bib_module.ThreadPoolExecutor(max_workers=4) as executor:
+            assert Bib_module.map_counted(executor, work, range(10)) == list(range(10))
+    assert bib.instrumentation.spans[-1]["counters"]["items"] == 45
+
+
+def test_find_duplicates_only_compares_buckets_with_new_signatures(library):
+    root, category_names = library
+    bibtex_file_path = os.path.join(root, "bib", category_names[0] + ".bib")
+    with open(bibtex_file_path, "a", encoding="utf-8") as file:
+        file.write("\n\n@article{Smith-2001-Plates,\n  title = {Folded plate structures with curved creases},\n"
+                   "  author = {Smith, John},\n}\n")
+    bib = Bib(category_names, root_folder_path=root, io_folder="io", trace=True)
+    quiet(bib.check)
+    quiet(bib.find_duplicates)
+    quiet(bib.find_duplicates)
+    assert bib.instrumentation.spans[-1]["counters"]["pairs compared"] == 0
+    with open(bibtex_file_path, "a", encoding="utf-8") as file:
+        file.write("\n\n@article{Smith-2002-Plates,\n  title = {Folded plate structures with curved crease},\n"
+                   "  author = {Smith, John},\n}\n")
+    quiet(bib.check)
+    duplicates = quiet(bib.find_duplicates)
+    assert 0 < bib.instrumentation.spans[-1]["counters"]["pairs compared"] < 10
+    assert [sorted(item["short_code"] for item in cluster) for cluster in duplicates] == [
+        ["Smith-2001-Plates", "Smith-2002-Plates"]]